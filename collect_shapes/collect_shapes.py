@@ -3,14 +3,19 @@
 # Requirements:
 #   <python> -m pip install pyshp numpy
 # Usage:
-#   <python> collect_shapes.py <county name> <town name>
+#   <python> collect_shapes.py <county name> <town name> [--validate-all]
 # Example usage:
 #   <python> collect_shapes.py 臺北市 南港區
 # Example output:
 #   shapes/臺北市_南港區.pkl
+#   shapes/臺北市_南港區.index.pkl (spatial index, see `shape_index.py`)
+#   shapes/臺北市_南港區.topology.pkl (shared arcs and adjacency, see `topology.py`)
 
 # Note that the generated pickles have no dependencies on phshp or numpy.
 
+# Each layer is validated before collecting features (see `validate_shapes.py`).
+# Overlaps are only tested for the selected town, unless --validate-all is given.
+
 # %% set target
 
 import sys
@@ -89,80 +94,64 @@ def calc_centroid(xy_list):
 def collect_parts(shape):
     assert shape.shapeType == 5, shape.shapeType
     idxs = list(shape.parts) + [None]
-    parts = []
-    centroids = []
-    for p in range(len(shape.parts)):
-        part = shape.points[idxs[p]:idxs[p+1]]
-        parts.append(part)
-        centroids.append(calc_centroid(part))
+    return [shape.points[idxs[p]:idxs[p+1]] for p in range(len(shape.parts))]
+
+def calc_feature(parts):
+    centroids = [calc_centroid(part) for part in parts]
     centroids.sort(key=lambda t: t[2]) # sort with area
     centroid = centroids[-1][:2] # use the centroid of the largest
     return parts, centroid
 
-towns = {}
-empty_name_count = 0
-for s in t_selection:
-    shape = t_shapes[s]
-    record = t_records[s]
-
-    # manual fixes for `鄉(鎮、市、區)界線1140318/Town_Majia_Sanhe`
-    if s == 368: # keep only part 1 since part 0 of t_shapes[368] is roughly same as t_shapes[132]
-        towns['瑪家鄉'][0].extend(collect_parts(shape)[0][1:]) # append parts
-        print(f'{record.COUNTYNAME} {record.TOWNNAME}: {2} parts')
-        continue
-
-    if len(shape.parts) > 1:
-        print(f'{record.COUNTYNAME} {record.TOWNNAME}: {len(shape.parts)} parts')
-    name = record.TOWNNAME
-    if name == '':
-        name = f'empty_{empty_name_count}'
-        empty_name_count += 1
-        print(f'renamed empty name into {name}')
-    assert name not in towns, f'found duplicate name: {name}'
-    towns[name] = collect_parts(shape)
-
-villages = {}
-empty_name_count = 0
-for s in v_selection:
-    shape = v_shapes[s]
-    record = v_records[s]
-    if len(shape.parts) > 1:
-        print(f'{record.COUNTYNAME} {record.TOWNNAME} {record.VILLNAME}: {len(shape.parts)} parts')
-    name = record.VILLNAME
-    if name == '':
-        name = f'empty_{empty_name_count}'
-        empty_name_count += 1
-        print(f'renamed empty name into {name}')
-    assert name not in villages, f'found duplicate name: {name}'
-    villages[name] = collect_parts(shape)
-
-neighborhoods = {}
-empty_name_count = 0
-for s in n_selection:
-    shape = n_shapes[s]
-    record = n_records[s]
-
-    # manual fixes for `臺北市鄰界圖_20250101_ShpTrans/G97_A_CALIN_P`
-    if s == 4471: # rows 4450, 4471 are both 臺北市/內湖區/紫陽里/12鄰
-        neighborhoods['紫陽里12鄰'][0].extend(collect_parts(shape)[0]) # append parts
-        print(f'臺北市 {record.SECT_NAME} {record.LIE_NAME} {record.SDFNAME}: {2} parts')
-        continue
-    elif s == 4943: # 臺北市/內湖區/金瑞里/2鄰 -> 臺北市/內湖區/金瑞里/22鄰
-        record.SDFNAME = '金瑞里22鄰'
-    elif s == 8719: # rows 8684, 8719 are both 臺北市/南港區/新光里/12鄰
-        neighborhoods['新光里12鄰'][0].extend(collect_parts(shape)[0]) # append parts
-        print(f'臺北市 {record.SECT_NAME} {record.LIE_NAME} {record.SDFNAME}: {2} parts')
-        continue
-
-    if len(shape.parts) > 1:
-        print(f'臺北市 {record.SECT_NAME} {record.LIE_NAME} {record.SDFNAME}: {len(shape.parts)} parts')
-    name = record.SDFNAME
-    if name == '':
-        name = f'empty_{empty_name_count}'
-        empty_name_count += 1
-        print(f'renamed empty name into {name}')
-    assert name not in neighborhoods, f'found duplicate name: {name}'
-    neighborhoods[name] = collect_parts(shape)
+# %% validate layers and collect features
+
+# Known data problems are fixed by the rules in `shape_rules.json`, see `validate_shapes.py`.
+from validate_shapes import load_rules, validate_layer, match_rule, merge_parts, estimate_gaps
+rules = load_rules('shape_rules.json')
+validate_all = '--validate-all' in argv
+
+def collect_features(layer, shapes, records, selection, key_fields, describe):
+    # key_fields: attributes identifying a record, the last of which is the name
+    validate_layer(layer, shapes, records, key_fields, None if validate_all else selection)
+    features = {}
+    empty_name_count = 0
+    for s in selection:
+        shape = shapes[s]
+        record = records[s]
+        parts = collect_parts(shape)
+        rule = match_rule(rules, layer, record, parts)
+        if len(parts) > 1:
+            print(f'{describe(record)}: {len(parts)} parts')
+        name = getattr(record, key_fields[-1])
+        if rule is not None and rule['action'] == 'rename':
+            print(f'{describe(record)}: renamed into {rule["name"]}')
+            name = rule['name']
+        if name == '':
+            name = f'empty_{empty_name_count}'
+            empty_name_count += 1
+            print(f'renamed empty name into {name}')
+        if name in features:
+            assert rule is not None and rule['action'] == 'merge', \
+                f'found duplicate name: {name}, add a merge or rename rule to shape_rules.json'
+            parts, dropped = merge_parts(features[name][0], parts, drop_parts=rule.get('drop_parts', ()))
+            print(f'{describe(record)}: merged into {len(parts)} parts, dropped {dropped} parts')
+            features[name] = parts, features[name][1] # keep the centroid of the first record
+            continue
+        features[name] = calc_feature(parts)
+    return features
+
+towns = collect_features('towns', t_shapes, t_records, t_selection, ('COUNTYNAME', 'TOWNNAME'),
+    lambda record: f'{record.COUNTYNAME} {record.TOWNNAME}')
+villages = collect_features('villages', v_shapes, v_records, v_selection, ('COUNTYNAME', 'TOWNNAME', 'VILLNAME'),
+    lambda record: f'{record.COUNTYNAME} {record.TOWNNAME} {record.VILLNAME}')
+neighborhoods = collect_features('neighborhoods', n_shapes, n_records, n_selection, ('SECT_NAME', 'SDFNAME'),
+    lambda record: f'臺北市 {record.SECT_NAME} {record.LIE_NAME} {record.SDFNAME}')
+
+# gaps of villages and neighborhoods in the selected towns
+from shape_index import LevelIndex
+for t_name, (parts, centroid) in towns.items():
+    for layer, features in (('villages', villages), ('neighborhoods', neighborhoods)):
+        gap, points = estimate_gaps(parts, LevelIndex(features))
+        print(f'{t_name}: {gap:.2%} of the area not covered by {layer}')
 
 # %% dump pkl
 
@@ -172,4 +161,16 @@ with open(f'../shapes/{file_name}', 'wb') as f:
     pickle.dump((towns, villages, neighborhoods), f)
 print(f'generated file in shapes/: {file_name}')
 
+# %% dump spatial index
+
+from shape_index import dump_index
+path = dump_index((towns, villages, neighborhoods), f'../shapes/{file_name}')
+print(f'generated file: {path}')
+
+# %% dump topology
+
+from topology import dump_topology
+path = dump_topology((towns, villages, neighborhoods), f'../shapes/{file_name}')
+print(f'generated file: {path}')
+
 # %%
@@ -0,0 +1,230 @@
+# Spatial index over the features of a shape pickle.
+
+# For each level (towns, villages, neighborhoods), the bounding boxes of the
+# features are packed into a Sort-Tile-Recursive (STR) R-tree. Point and bbox
+# queries descend the tree level by level with vectorized bbox tests, and point
+# queries are refined with a vectorized even-odd point-in-polygon test.
+
+# The index is built by `collect_shapes.py` and saved next to the shape pickle:
+#   shapes/臺北市_南港區.pkl        (towns, villages, neighborhoods)
+#   shapes/臺北市_南港區.index.pkl  index of the above
+# Like the shape pickles, the index pickles contain only built-in types.
+
+# Requirements:
+#   <python> -m pip install numpy
+# Usage (rebuild the index of an existing shape pickle):
+#   <python> shape_index.py <path to shape pickle>
+# Example usage:
+#   <python> shape_index.py ../shapes/臺北市_南港區.pkl
+# Example output:
+#   shapes/臺北市_南港區.index.pkl
+# Example usage as a module:
+#   import sys; sys.path.append('../collect_shapes')
+#   from shape_index import ShapeIndex
+#   index = ShapeIndex.load('../shapes/臺北市_南港區.pkl')
+#   index.neighborhoods.query_points([[121.61, 25.05]]) # -> ['三重里22鄰'] or [None]
+#   index.villages.query_bbox((121.60, 25.04, 121.62, 25.06)) # -> ['三重里', ...]
+
+import pickle
+import numpy as np
+
+LEVELS = ('towns', 'villages', 'neighborhoods')
+NODE_CAPACITY = 16
+
+def index_path(shape_path):
+    assert shape_path.endswith('.pkl'), shape_path
+    return shape_path[:-len('.pkl')] + '.index.pkl'
+
+# %% build
+
+def calc_bbox(parts):
+    xy = np.concatenate([np.asarray(part, dtype=np.float64) for part in parts])
+    return (*xy.min(axis=0).tolist(), *xy.max(axis=0).tolist())
+
+def str_pack(bboxes, capacity=NODE_CAPACITY):
+    # Sort-Tile-Recursive packing. Returns the leaf order (a permutation of the
+    # features) and the bboxes of the inner nodes from bottom to top. Node i of
+    # a level covers children [i * capacity, (i + 1) * capacity) of the level
+    # below it, so no child pointers need to be stored.
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    n = len(bboxes)
+    order = np.arange(n)
+    if n > 0:
+        cx = (bboxes[:, 0] + bboxes[:, 2]) / 2
+        cy = (bboxes[:, 1] + bboxes[:, 3]) / 2
+        slice_size = capacity * int(np.ceil(np.sqrt(np.ceil(n / capacity))))
+        order = np.argsort(cx, kind='stable')
+        for start in range(0, n, slice_size):
+            s = order[start:start+slice_size]
+            order[start:start+slice_size] = s[np.argsort(cy[s], kind='stable')]
+    levels = []
+    level = bboxes[order]
+    while len(level) > 1:
+        starts = np.arange(0, len(level), capacity)
+        level = np.stack([
+            np.minimum.reduceat(level[:, 0], starts),
+            np.minimum.reduceat(level[:, 1], starts),
+            np.maximum.reduceat(level[:, 2], starts),
+            np.maximum.reduceat(level[:, 3], starts),
+        ], axis=1)
+        levels.append(level)
+    return order, levels
+
+def build_level_index(features):
+    # features: {name: (parts, centroid)}, as in the shape pickles
+    names = list(features)
+    bboxes = [calc_bbox(features[name][0]) for name in names]
+    order, nodes = str_pack(bboxes)
+    return {
+        'names': names,
+        'bboxes': bboxes,
+        'order': order.tolist(),
+        'nodes': [level.tolist() for level in nodes],
+    }
+
+def build_index(shapes):
+    return {level: build_level_index(features) for level, features in zip(LEVELS, shapes)}
+
+def dump_index(shapes, shape_path):
+    path = index_path(shape_path)
+    with open(path, 'wb') as f:
+        pickle.dump(build_index(shapes), f)
+    return path
+
+# %% query
+
+class LevelIndex:
+    def __init__(self, features, data=None):
+        if data is None:
+            data = build_level_index(features)
+        assert data['names'] == list(features), 'index does not match the shapes'
+        self.names = data['names']
+        self.bboxes = np.asarray(data['bboxes'], dtype=np.float64).reshape(-1, 4)
+        self.order = np.asarray(data['order'], dtype=np.intp)
+        self.leaf_bboxes = self.bboxes[self.order]
+        self.nodes = [np.asarray(level, dtype=np.float64).reshape(-1, 4) for level in data['nodes']]
+        self.capacity = NODE_CAPACITY
+
+        # edges of all parts of all features, grouped by feature
+        x0, y0, x1, y1 = [], [], [], []
+        edge_counts = []
+        for name in self.names:
+            count = 0
+            for part in features[name][0]:
+                xy = np.asarray(part, dtype=np.float64)
+                x0.append(xy[:-1, 0])
+                y0.append(xy[:-1, 1])
+                x1.append(xy[1:, 0])
+                y1.append(xy[1:, 1])
+                count += len(xy) - 1
+            edge_counts.append(count)
+        empty = np.zeros(0)
+        self.edges = np.stack([np.concatenate(a) if a else empty for a in (x0, y0, x1, y1)], axis=1)
+        self.edge_offsets = np.concatenate([[0], np.cumsum(edge_counts)]).astype(np.intp)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _descend(self, qx0, qy0, qx1, qy1):
+        # Return (query, feature) pairs whose bboxes intersect. Queries are
+        # given as bbox arrays; points are bboxes of zero size.
+        levels = self.nodes[::-1] + [self.leaf_bboxes]
+        top = len(levels[0])
+        q = np.repeat(np.arange(len(qx0)), top)
+        c = np.tile(np.arange(top), len(qx0))
+        for l, level in enumerate(levels):
+            b = level[c]
+            hit = (b[:, 0] <= qx1[q]) & (b[:, 2] >= qx0[q]) & (b[:, 1] <= qy1[q]) & (b[:, 3] >= qy0[q])
+            q, c = q[hit], c[hit]
+            if l + 1 < len(levels): # expand to children
+                q = np.repeat(q, self.capacity)
+                c = (c[:, None] * self.capacity + np.arange(self.capacity)).ravel()
+                valid = c < len(levels[l+1])
+                q, c = q[valid], c[valid]
+        return q, self.order[c]
+
+    def contains(self, px, py, features, chunk_size=1 << 22):
+        # Vectorized even-odd test of points (px[i], py[i]) against features[i].
+        # Points are processed in chunks of about chunk_size edge tests.
+        px, py, features = np.asarray(px), np.asarray(py), np.asarray(features, dtype=np.intp)
+        starts = self.edge_offsets[features]
+        counts = self.edge_offsets[features + 1] - starts
+        inside = np.zeros(len(px), dtype=bool)
+        cum = np.cumsum(counts)
+        begin = 0
+        while begin < len(px):
+            end = max(begin + 1, int(np.searchsorted(cum, cum[begin] - counts[begin] + chunk_size, 'right')))
+            c = counts[begin:end]
+            pair = np.repeat(np.arange(end - begin), c)
+            edge = np.arange(c.sum()) - np.repeat(np.cumsum(c) - c, c) + np.repeat(starts[begin:end], c)
+            x0, y0, x1, y1 = self.edges[edge].T
+            x, y = px[begin:end][pair], py[begin:end][pair]
+            crosses = (y0 > y) != (y1 > y)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+            crosses &= x < x_cross
+            inside[begin:end] = np.bincount(pair, weights=crosses, minlength=end - begin).astype(np.int64) % 2 == 1
+            begin = end
+        return inside
+
+    def intersecting_pairs(self):
+        # (i, j) pairs of features with i < j whose bboxes intersect
+        qx0, qy0, qx1, qy1 = self.bboxes.T
+        q, f = self._descend(qx0, qy0, qx1, qy1)
+        keep = q < f
+        return q[keep], f[keep]
+
+    def query_bbox_ids(self, bbox):
+        # ids of the features whose bboxes intersect bbox = (x0, y0, x1, y1)
+        qx0, qy0, qx1, qy1 = (np.array([v], dtype=np.float64) for v in bbox)
+        return np.sort(self._descend(qx0, qy0, qx1, qy1)[1])
+
+    def query_bbox(self, bbox):
+        return [self.names[i] for i in self.query_bbox_ids(bbox)]
+
+    def query_point_ids(self, points):
+        # id of the feature containing each point, -1 if none
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        px, py = points[:, 0], points[:, 1]
+        result = np.full(len(points), -1, dtype=np.intp)
+        q, f = self._descend(px, py, px, py)
+        hit = self.contains(px[q], py[q], f)
+        q, f = q[hit], f[hit]
+        o = np.argsort(f, kind='stable')[::-1]
+        result[q[o]] = f[o] # the first feature wins if features overlap
+        return result
+
+    def query_points(self, points):
+        return [self.names[i] if i >= 0 else None for i in self.query_point_ids(points)]
+
+class ShapeIndex:
+    def __init__(self, shapes, data=None):
+        for level, features in zip(LEVELS, shapes):
+            setattr(self, level, LevelIndex(features, None if data is None else data[level]))
+        self.shapes = shapes
+
+    @classmethod
+    def load(cls, shape_path):
+        # load a shape pickle and its index, building the index if not found
+        with open(shape_path, 'rb') as f:
+            shapes = pickle.load(f)
+        try:
+            with open(index_path(shape_path), 'rb') as f:
+                data = pickle.load(f)
+        except FileNotFoundError:
+            print(f'index not found for {shape_path}, building in memory')
+            data = None
+        return cls(shapes, data)
+
+# %% rebuild the index of an existing shape pickle
+
+if __name__ == '__main__':
+    import sys
+    argv = sys.argv
+    assert len(argv) >= 2, argv
+    for shape_path in argv[1:]:
+        with open(shape_path, 'rb') as f:
+            shapes = pickle.load(f)
+        print(f'generated file: {dump_index(shapes, shape_path)}')
+
+# %%
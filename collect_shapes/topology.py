@@ -0,0 +1,204 @@
+# Shared-arc topology and adjacency graph of the features of a shape pickle.
+
+# For each level (towns, villages, neighborhoods), vertices are quantized and
+# the rings of all features are cut at junctions, i.e., vertices where the
+# neighboring vertices differ between rings. The resulting arcs are
+# deduplicated, so that a boundary shared by two features is stored (and
+# drawn) once. Each feature is a list of parts, and each part is a list of arc
+# ids, where ~i means arc i reversed (as in TopoJSON). Features sharing an arc
+# are adjacent, and the adjacency graph is stored in CSR form.
+
+# The topology is built by `collect_shapes.py` and saved next to the shape pickle:
+#   shapes/臺北市_南港區.pkl           (towns, villages, neighborhoods)
+#   shapes/臺北市_南港區.topology.pkl  topology of the above
+# Like the shape pickles, the topology pickles contain only built-in types:
+#   {'towns': level, 'villages': level, 'neighborhoods': level}, where level is
+#   {
+#       'names':   [name, ...],
+#       'arcs':    [[(x, y), ...], ...],
+#       'parts':   [[[arc id, ...], ...], ...], # parts of each feature
+#       'indptr':  [...], # adjacency graph in CSR form: the neighbors of
+#       'indices': [...], # feature i are indices[indptr[i]:indptr[i+1]]
+#   }
+# Since shared boundaries are stored once, simplifying the arcs (see
+# `simplify_level`) keeps adjacent features free of gaps and overlaps.
+
+# Requirements:
+#   <python> -m pip install numpy
+# Usage (rebuild the topology of an existing shape pickle):
+#   <python> topology.py <path to shape pickle>
+# Example usage:
+#   <python> topology.py ../shapes/臺北市_南港區.pkl
+# Example output:
+#   shapes/臺北市_南港區.topology.pkl
+
+import pickle
+import numpy as np
+
+LEVELS = ('towns', 'villages', 'neighborhoods')
+PRECISION = 1e-7 # in degrees, about 1 cm
+
+def topology_path(shape_path):
+    assert shape_path.endswith('.pkl'), shape_path
+    return shape_path[:-len('.pkl')] + '.topology.pkl'
+
+def quantize(part, precision=PRECISION):
+    # ring of a part as int64 keys, without the closing vertex and repeated vertices
+    q = np.round(np.asarray(part, dtype=np.float64) / precision).astype(np.int64)
+    keys = (q[:, 0] << 32) | (q[:, 1] & 0xFFFFFFFF)
+    if len(keys) > 1 and keys[0] == keys[-1]:
+        keys = keys[:-1]
+    keep = keys != np.roll(keys, 1)
+    keep[0] = True
+    return keys[keep]
+
+def dequantize(keys, precision=PRECISION):
+    keys = np.asarray(keys, dtype=np.int64)
+    x = (keys >> 32) * precision
+    y = (keys & 0xFFFFFFFF).astype(np.int32) * precision # sign of y is restored by int32
+    return list(zip(x.tolist(), y.tolist()))
+
+def find_junctions(rings):
+    # vertices whose (unordered) neighboring vertices differ between occurrences
+    if len(rings) == 0:
+        return np.zeros(0, dtype=np.int64)
+    point = np.concatenate(rings)
+    prev = np.concatenate([np.roll(r, 1) for r in rings])
+    nxt = np.concatenate([np.roll(r, -1) for r in rings])
+    lo, hi = np.minimum(prev, nxt), np.maximum(prev, nxt)
+    occurrences = np.unique(np.stack([point, lo, hi], axis=1), axis=0)
+    points, counts = np.unique(occurrences[:, 0], return_counts=True)
+    return points[counts > 1]
+
+def build_level_topology(features, precision=PRECISION):
+    # features: {name: (parts, centroid)}, as in the shape pickles
+    names = list(features)
+    rings = [[quantize(part, precision) for part in features[name][0]] for name in names]
+    junctions = find_junctions([ring for parts in rings for ring in parts])
+
+    arcs = []
+    arc_ids = {}
+    def arc_id(arc):
+        arc = tuple(arc)
+        if arc in arc_ids:
+            return arc_ids[arc]
+        if arc[::-1] in arc_ids:
+            return ~arc_ids[arc[::-1]]
+        arc_ids[arc] = len(arcs)
+        arcs.append(arc)
+        return arc_ids[arc]
+
+    parts = []
+    for feature_rings in rings:
+        feature_parts = []
+        for ring in feature_rings:
+            is_junction = np.isin(ring, junctions)
+            if not is_junction.any():
+                # a ring without junctions is a single arc, starting at its smallest vertex
+                ring = np.roll(ring, -int(ring.argmin())).tolist()
+                feature_parts.append([arc_id(ring + ring[:1])])
+                continue
+            start = int(is_junction.argmax())
+            ring = np.roll(ring, -start).tolist()
+            cuts = np.flatnonzero(np.roll(is_junction, -start)).tolist() + [len(ring)]
+            ring.append(ring[0])
+            feature_parts.append([arc_id(ring[a:b+1]) for a, b in zip(cuts[:-1], cuts[1:])])
+        parts.append(feature_parts)
+
+    # adjacency: features sharing an arc
+    feature = np.array([f for f, feature_parts in enumerate(parts) for part in feature_parts for a in part], dtype=np.intp)
+    arc = np.array([a if a >= 0 else ~a for feature_parts in parts for part in feature_parts for a in part], dtype=np.intp)
+    pairs = np.unique(np.stack([arc, feature], axis=1), axis=0).reshape(-1, 2)
+    starts = np.flatnonzero(np.diff(pairs[:, 0], prepend=-1))
+    counts = np.diff(np.append(starts, len(pairs)))
+    src, dst = [], []
+    for start, count in zip(starts[counts > 1], counts[counts > 1]):
+        f = pairs[start:start+count, 1]
+        src.append(np.repeat(f, count))
+        dst.append(np.tile(f, count))
+    src = np.concatenate(src) if src else np.zeros(0, dtype=np.intp)
+    dst = np.concatenate(dst) if dst else np.zeros(0, dtype=np.intp)
+    edges = np.unique(np.stack([src, dst], axis=1)[src != dst], axis=0).reshape(-1, 2)
+    indptr = np.searchsorted(edges[:, 0], np.arange(len(names) + 1))
+
+    return {
+        'names': names,
+        'arcs': [dequantize(a, precision) for a in arcs],
+        'parts': parts,
+        'indptr': indptr.tolist(),
+        'indices': edges[:, 1].tolist(),
+    }
+
+def build_topology(shapes):
+    return {level: build_level_topology(features) for level, features in zip(LEVELS, shapes)}
+
+def dump_topology(shapes, shape_path):
+    path = topology_path(shape_path)
+    with open(path, 'wb') as f:
+        pickle.dump(build_topology(shapes), f)
+    return path
+
+# %% simplify
+
+def simplify_arc(arc, tolerance):
+    # Douglas-Peucker simplification of an arc, keeping its end points
+    xy = np.asarray(arc, dtype=np.float64)
+    keep = np.zeros(len(xy), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(xy) - 1)]
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+        p = xy[a+1:b] - xy[a]
+        d = xy[b] - xy[a]
+        norm = np.hypot(*d)
+        if norm == 0: # closed arc: distance to the end point
+            dist = np.hypot(p[:, 0], p[:, 1])
+        else:
+            dist = np.abs(p[:, 0] * d[1] - p[:, 1] * d[0]) / norm
+        k = int(dist.argmax())
+        if dist[k] > tolerance:
+            keep[a + 1 + k] = True
+            stack += [(a, a + 1 + k), (a + 1 + k, b)]
+    return [tuple(v) for v in xy[keep].tolist()]
+
+def level_parts(level, arcs=None):
+    # {name: parts} of a level, with the rings rebuilt from arcs (level['arcs'] by default)
+    if arcs is None:
+        arcs = level['arcs']
+    features = {}
+    for name, feature_parts in zip(level['names'], level['parts']):
+        parts = []
+        for part in feature_parts:
+            ring = []
+            for a in part:
+                arc = arcs[a] if a >= 0 else arcs[~a][::-1]
+                ring += arc if not ring else arc[1:]
+            parts.append(ring)
+        features[name] = parts
+    return features
+
+def simplify_level(level, tolerance):
+    # {name: parts} of a level with simplified arcs. Rings collapsing to less
+    # than a triangle are kept unsimplified.
+    simplified = level_parts(level, [simplify_arc(arc, tolerance) for arc in level['arcs']])
+    original = level_parts(level)
+    for name, parts in simplified.items():
+        for p, part in enumerate(parts):
+            if len(part) < 4:
+                parts[p] = original[name][p]
+    return simplified
+
+# %% rebuild the topology of an existing shape pickle
+
+if __name__ == '__main__':
+    import sys
+    argv = sys.argv
+    assert len(argv) >= 2, argv
+    for shape_path in argv[1:]:
+        with open(shape_path, 'rb') as f:
+            shapes = pickle.load(f)
+        print(f'generated file: {dump_topology(shapes, shape_path)}')
+
+# %%
@@ -0,0 +1,212 @@
+# Validate the geometry of shapefile layers and apply merge/rename rules.
+
+# Checks, each vectorized with NumPy over the whole layer:
+#   duplicate names      records sharing the same key attributes
+#   near-identical parts parts of different records with almost the same
+#                        bbox and area, e.g., a part repeated in two files
+#   overlaps             pairs of records whose bboxes intersect (found with
+#                        the STR-tree of `shape_index.py`) are tested for
+#                        overlapping area, estimated by sampling points in the
+#                        bbox intersection, and overlapping pairs are tested
+#                        for crossing boundary segments
+#   gaps                 area of a parent record (e.g., a town) not covered by
+#                        any record of a child layer (e.g., villages)
+
+# Known data problems are fixed by rules in `shape_rules.json`, keyed by
+# attributes instead of record indices, so that they survive new releases:
+#   {"layer": "neighborhoods", "match": {"SECT_NAME": "內湖區", "SDFNAME": "紫陽里12鄰"},
+#    "action": "merge"}
+#       Merge all matching records into one feature, dropping parts that are
+#       near-identical to parts already collected. "drop_parts": [<part index>, ...]
+#       explicitly drops parts of the records merged into the first one, and
+#       warns if a dropped part is not near-identical to a collected part.
+#   {"layer": "neighborhoods", "match": {"SDFNAME": "金瑞里2鄰"}, "contains": [121.575, 25.098],
+#    "action": "rename", "name": "金瑞里22鄰"}
+#       Rename the matching records. "contains" optionally restricts the rule
+#       to records containing the given longitude and latitude.
+# Duplicate names without a merge rule are errors, as before.
+
+# Requirements:
+#   <python> -m pip install numpy
+# Example usage as a module (see `collect_shapes.py`):
+#   from validate_shapes import load_rules, validate_layer, match_rule, merge_parts
+#   rules = load_rules('shape_rules.json')
+
+import json
+import numpy as np
+from shape_index import LevelIndex
+
+PART_TOLERANCE = 0.01 # relative tolerance of near-identical parts
+OVERLAP_TOLERANCE = 0.01 # overlapping area relative to the smaller record
+OVERLAP_SAMPLES = 8 # samples per axis in the bbox intersection of a pair
+
+def load_rules(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def part_area(part):
+    x, y = np.asarray(part, dtype=np.float64).T
+    return abs(float((x[:-1] * y[1:] - x[1:] * y[:-1]).sum() / 2))
+
+# %% checks
+
+def find_duplicates(keys):
+    # {key: [record ids]} of keys appearing more than once
+    ids = {}
+    for i, key in enumerate(keys):
+        ids.setdefault(key, []).append(i)
+    return {key: i for key, i in ids.items() if len(i) > 1}
+
+def find_near_identical_parts(parts_list, tolerance=PART_TOLERANCE):
+    # ((record, part), (record, part)) pairs of different records with
+    # bboxes and areas equal up to tolerance times the size of the bbox
+    owners = [(r, p) for r, parts in enumerate(parts_list) for p in range(len(parts))]
+    parts = {i: ([part], None) for i, part in enumerate(part for parts in parts_list for part in parts)}
+    if len(parts) < 2:
+        return []
+    index = LevelIndex(parts)
+    i, j = index.intersecting_pairs()
+    owner = np.array([r for r, p in owners])
+    i, j = i[owner[i] != owner[j]], j[owner[i] != owner[j]]
+    b = index.bboxes
+    size = np.maximum(b[:, 2] - b[:, 0], b[:, 3] - b[:, 1])
+    close = (np.abs(b[i] - b[j]).max(axis=1) <= tolerance * np.maximum(size[i], size[j])) | \
+        (np.abs(b[i] - b[j]).max(axis=1) <= 1e-9)
+    i, j = i[close], j[close]
+    areas = np.array([part_area(parts[k][0][0]) for k in range(len(parts))])
+    close = np.abs(areas[i] - areas[j]) <= tolerance * np.maximum(areas[i], areas[j]) + 1e-18
+    return [(owners[a], owners[b]) for a, b in zip(i[close], j[close])]
+
+def count_crossings(index, i, j, chunk_size=1 << 22):
+    # number of properly crossing segments between records i[k] and j[k]
+    counts = np.zeros(len(i), dtype=np.int64)
+    offsets = index.edge_offsets
+    ni = offsets[i + 1] - offsets[i]
+    nj = offsets[j + 1] - offsets[j]
+    for k in range(len(i)):
+        if ni[k] * nj[k] == 0:
+            continue
+        a = index.edges[offsets[i[k]]:offsets[i[k]+1]]
+        b = index.edges[offsets[j[k]]:offsets[j[k]+1]]
+        # only segments within the bbox intersection can cross
+        x0 = max(index.bboxes[i[k], 0], index.bboxes[j[k], 0])
+        y0 = max(index.bboxes[i[k], 1], index.bboxes[j[k], 1])
+        x1 = min(index.bboxes[i[k], 2], index.bboxes[j[k], 2])
+        y1 = min(index.bboxes[i[k], 3], index.bboxes[j[k], 3])
+        def within(e):
+            return (np.minimum(e[:, 0], e[:, 2]) <= x1) & (np.maximum(e[:, 0], e[:, 2]) >= x0) & \
+                (np.minimum(e[:, 1], e[:, 3]) <= y1) & (np.maximum(e[:, 1], e[:, 3]) >= y0)
+        a, b = a[within(a)], b[within(b)]
+        for start in range(0, len(a), max(1, chunk_size // max(1, len(b)))):
+            counts[k] += segments_cross(a[start:start + max(1, chunk_size // max(1, len(b)))], b).sum()
+    return counts
+
+def segments_cross(a, b):
+    # (len(a), len(b)) matrix of whether segments a and b properly cross
+    ax0, ay0, ax1, ay1 = (v[:, None] for v in a.T)
+    bx0, by0, bx1, by1 = (v[None, :] for v in b.T)
+    def orient(px, py, qx, qy, rx, ry):
+        return np.sign((qx - px) * (ry - py) - (qy - py) * (rx - px))
+    return (orient(ax0, ay0, ax1, ay1, bx0, by0) * orient(ax0, ay0, ax1, ay1, bx1, by1) < 0) & \
+        (orient(bx0, by0, bx1, by1, ax0, ay0) * orient(bx0, by0, bx1, by1, ax1, ay1) < 0)
+
+def estimate_overlaps(index, i, j, areas, samples=OVERLAP_SAMPLES):
+    # overlapping area of records i[k] and j[k], relative to the smaller one,
+    # estimated by a samples x samples grid in the bbox intersection
+    x0 = np.maximum(index.bboxes[i, 0], index.bboxes[j, 0])
+    y0 = np.maximum(index.bboxes[i, 1], index.bboxes[j, 1])
+    x1 = np.minimum(index.bboxes[i, 2], index.bboxes[j, 2])
+    y1 = np.minimum(index.bboxes[i, 3], index.bboxes[j, 3])
+    t = (np.arange(samples) + 0.5) / samples
+    px = (x0[:, None, None] + (x1 - x0)[:, None, None] * t[None, None, :]).repeat(samples, axis=1).ravel()
+    py = (y0[:, None, None] + (y1 - y0)[:, None, None] * t[None, :, None]).repeat(samples, axis=2).ravel()
+    fi = np.repeat(i, samples * samples)
+    fj = np.repeat(j, samples * samples)
+    both = index.contains(px, py, fi)
+    both[both] &= index.contains(px[both], py[both], fj[both])
+    area = both.reshape(len(i), samples * samples).mean(axis=1) * (x1 - x0) * (y1 - y0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.nan_to_num(area / np.minimum(areas[i], areas[j]))
+
+def estimate_gaps(parent_parts, index, samples=200):
+    # area of the parent not covered by any record of index, relative to the parent
+    parent = LevelIndex({0: (parent_parts, None)})
+    x0, y0, x1, y1 = parent.bboxes[0]
+    t = (np.arange(samples) + 0.5) / samples
+    px, py = np.meshgrid(x0 + (x1 - x0) * t, y0 + (y1 - y0) * t)
+    px, py = px.ravel(), py.ravel()
+    inside = parent.contains(px, py, np.zeros(len(px), dtype=np.intp))
+    if not inside.any():
+        return 0.0, np.zeros((0, 2))
+    uncovered = index.query_point_ids(np.stack([px[inside], py[inside]], axis=1)) < 0
+    return float(uncovered.mean()), np.stack([px[inside][uncovered], py[inside][uncovered]], axis=1)
+
+# %% validate
+
+def validate_layer(layer, shapes, records, key_fields, selection=None):
+    # Run the checks on a whole layer and print the problems found. Problems
+    # involving the selected record ids are printed in detail. Since testing
+    # the overlaps of a nationwide layer takes minutes, only pairs involving
+    # the selection are tested, unless selection is None.
+    keys = [tuple(getattr(record, field) for field in key_fields) for record in records]
+    parts_list = [[shape.points[a:b] for a, b in zip(shape.parts, list(shape.parts[1:]) + [None])] for shape in shapes]
+    ids = np.array([r for r, parts in enumerate(parts_list) if len(parts) > 0], dtype=np.intp)
+    index = LevelIndex({r: (parts_list[r], None) for r in ids})
+    selected = np.ones(len(records), dtype=bool)
+    if selection is not None:
+        selected[:] = False
+        selected[list(selection)] = True
+    def show(r):
+        return f'#{r} {" ".join(keys[r])}'
+
+    duplicates = find_duplicates(keys)
+    print(f'{layer}: {len(duplicates)} duplicate names')
+    for key, rs in duplicates.items():
+        if selected[rs].any():
+            print(f'  duplicate name: {" ".join(key)}: records {rs}')
+
+    pairs = find_near_identical_parts([parts_list[r] for r in ids])
+    print(f'{layer}: {len(pairs)} near-identical parts')
+    for (a, p), (b, q) in pairs:
+        if selected[ids[a]] or selected[ids[b]]:
+            print(f'  near-identical parts: {show(ids[a])} part {p}, {show(ids[b])} part {q}')
+
+    i, j = index.intersecting_pairs()
+    keep = selected[ids[i]] | selected[ids[j]]
+    i, j = i[keep], j[keep]
+    areas = np.array([sum(part_area(part) for part in parts_list[r]) for r in ids])
+    overlaps = estimate_overlaps(index, i, j, areas)
+    overlapping = overlaps > OVERLAP_TOLERANCE
+    i, j, overlaps = i[overlapping], j[overlapping], overlaps[overlapping]
+    crossings = count_crossings(index, i, j)
+    print(f'{layer}: {len(overlaps)} overlapping pairs' + ('' if selection is None else ' involving the selection'))
+    for a, b, overlap, crossing in zip(i, j, overlaps, crossings):
+        print(f'  overlap: {show(ids[a])}, {show(ids[b])}: {overlap:.1%} of the smaller, {crossing} crossing segments')
+
+def match_rule(rules, layer, record, parts):
+    # the first rule of layer matching the attributes (and location) of record
+    for rule in rules:
+        if rule['layer'] != layer:
+            continue
+        if any(getattr(record, field) != value for field, value in rule.get('match', {}).items()):
+            continue
+        if 'contains' in rule:
+            x, y = rule['contains']
+            index = LevelIndex({0: (parts, None)})
+            if not index.contains(np.array([x]), np.array([y]), np.zeros(1, dtype=np.intp))[0]:
+                continue
+        return rule
+    return None
+
+def merge_parts(parts, new_parts, tolerance=PART_TOLERANCE, drop_parts=()):
+    # parts + the new parts which are neither near-identical to any of the
+    # parts nor explicitly dropped
+    pairs = find_near_identical_parts([parts, new_parts], tolerance)
+    dropped = {q for (a, p), (b, q) in pairs}
+    for q in drop_parts:
+        if q not in dropped:
+            print(f'warning: dropped part {q} is not near-identical to any collected part')
+    dropped |= set(drop_parts)
+    return parts + [part for q, part in enumerate(new_parts) if q not in dropped], len(dropped)
+
+# %%
@@ -0,0 +1,163 @@
+# Aggregate counts of polling places to upper divisions with sparse matrices.
+
+# The relationships between divisions are expressed as sparse incidence matrices:
+#   polling place -> neighborhood       apportioned, see below
+#   neighborhood  -> village            0 or 1
+#   village       -> town               0 or 1
+#   village       -> electoral district 0 or 1
+# Each matrix has a row per parent and a column per child, so that the counts
+# of all parents are a single sparse matrix product with the counts of the
+# children. The products with polling places are precomputed, so aggregating a
+# table of polling places to every level takes one sparse product per level.
+
+# Polling places composed of neighborhoods from different villages, such as
+# PPID 224 of 魚池鄉 (新城村17鄰、共和村4-11鄰), are apportioned to their
+# neighborhoods, equally by default or by neighborhood weights if given. This
+# makes the village counts include the counts of such polling places, unlike
+# the PPID == 0 rows of the votedata database (see `distill_legislators.py`).
+
+# Requirements:
+#   <python> -m pip install pandas numpy scipy
+# Example usage as a module:
+#   from aggregate import Aggregator
+#   agg = Aggregator.from_pp_list('臺北市', '南港區', village_ECODE={'南港里': 4, ...})
+#   tables = agg.aggregate_all(table) # table: rows of polling places in agg.labels['polling place']
+# The name parsers need only NumPy, so that scripts splitting polling place
+# names do not need SciPy:
+#   from aggregate import parse_neighborhood_name
+
+import numpy as np
+
+LEVELS = ('polling place', 'neighborhood', 'village', 'town', 'electoral district')
+
+def parse_neighborhoods(NEIGHBORHOODS):
+    # e.g., '1,14,15,17-20鄰' -> [1, 14, 15, 17, 18, 19, 20], '所有的鄰' -> None
+    if NEIGHBORHOODS == '所有的鄰':
+        return None
+    assert len(NEIGHBORHOODS) > 1, NEIGHBORHOODS
+    assert NEIGHBORHOODS[-1] == '鄰', NEIGHBORHOODS
+    nums = NEIGHBORHOODS[:-1].replace('、', ',').replace(', ', ',')
+    assert all(c in '0123456789-,' for c in nums), nums
+    numbers = []
+    for num in nums.split(','):
+        if '-' in num: # e.g., '9-12'
+            num = num.split('-')
+            assert len(num) == 2, num
+            start, stop = num
+            numbers.extend(range(int(start), int(stop) + 1))
+        else: # e.g., '3'
+            numbers.append(int(num))
+    return numbers
+
+def parse_neighborhood_name(pp_name, n_names=()):
+    # villages and neighborhoods of a polling place name of the distilled CSV
+    # files, where '所有的鄰' is expanded to the neighborhoods of the village in
+    # n_names, e.g., '南港里_2_3 中南里_所有的鄰' ->
+    #   (['南港里', '中南里'], ['南港里2鄰', '南港里3鄰', '中南里1鄰', '中南里2鄰', ...])
+    v_name_list = []
+    n_name_list = []
+    for village in pp_name.split(' '):
+        village = village.split('_')
+        v_name = village[0]
+        v_name_list.append(v_name)
+        for n_number in village[1:]:
+            if n_number == '所有的鄰':
+                n_name_list += [n for n in n_names if n.startswith(v_name) and n.endswith('鄰') and n[len(v_name):-1].isdigit()]
+            else:
+                n_name_list.append(f'{v_name}{n_number}鄰')
+    return v_name_list, n_name_list
+
+def incidence(children, parents, child_labels=None, parent_labels=None, weights=None):
+    # Build a sparse matrix of shape (len(parent_labels), len(child_labels)),
+    # with weights[i] at (parents[i], children[i]). Labels default to the
+    # unique values in the order of first appearance.
+    import scipy.sparse
+    if child_labels is None:
+        child_labels = list(dict.fromkeys(children))
+    if parent_labels is None:
+        parent_labels = list(dict.fromkeys(parents))
+    cidx = {label: i for i, label in enumerate(child_labels)}
+    pidx = {label: i for i, label in enumerate(parent_labels)}
+    cols = np.array([cidx[c] for c in children], dtype=np.intp)
+    rows = np.array([pidx[p] for p in parents], dtype=np.intp)
+    if weights is None:
+        weights = np.ones(len(cols))
+    matrix = scipy.sparse.csr_matrix((weights, (rows, cols)), shape=(len(parent_labels), len(child_labels)))
+    matrix.sum_duplicates()
+    return matrix, child_labels, parent_labels
+
+class Aggregator:
+    def __init__(self, pp_rows, village_ECODE=None, neighborhood_weights=None):
+        # pp_rows: list of (polling place, town, village, neighborhood numbers or None),
+        #   with a row for each village of a polling place. Towns have to be
+        #   unique across counties, e.g., '臺北市 中正區' and '基隆市 中正區'.
+        # village_ECODE: {(town, village): ECODE}, optional.
+        # neighborhood_weights: {(town, neighborhood): weight}, optional, for
+        #   apportioning, e.g., {('臺北市 南港區', '南港里2鄰'): 312, ...}.
+        pps, neighborhoods, villages = [], [], []
+        for pp, town, village, numbers in pp_rows:
+            for n_name in [village] if numbers is None else [f'{village}{n}鄰' for n in numbers]:
+                pps.append(pp)
+                neighborhoods.append((town, n_name))
+                villages.append((town, village))
+
+        # polling place -> neighborhood: each column sums to 1
+        pp_labels = list(dict.fromkeys(pps))
+        pidx = {pp: i for i, pp in enumerate(pp_labels)}
+        p = np.array([pidx[pp] for pp in pps], dtype=np.intp)
+        weights = np.ones(len(pps))
+        if neighborhood_weights is not None:
+            weights = np.array([neighborhood_weights.get(n, 0.0) for n in neighborhoods], dtype=np.float64)
+            unweighted = np.bincount(p, weights, minlength=len(pp_labels)) == 0
+            weights[unweighted[p]] = 1.0 # fall back to equal weights
+        weights /= np.bincount(p, weights, minlength=len(pp_labels))[p]
+        P, pp_labels, n_labels = incidence(pps, neighborhoods, pp_labels, weights=weights)
+
+        # neighborhood -> village -> town, electoral district
+        first = {n: i for i, n in reversed(list(enumerate(neighborhoods)))}
+        V, _, v_labels = incidence(n_labels, [villages[first[n]] for n in n_labels], n_labels)
+        T, _, t_labels = incidence(v_labels, [v[0] for v in v_labels], v_labels)
+        self.matrices = {'neighborhood': P, 'village': (V @ P).tocsr()}
+        self.matrices['town'] = (T @ self.matrices['village']).tocsr()
+        self.labels = {
+            'polling place': pp_labels,
+            'neighborhood': [n for t, n in n_labels],
+            'village': [v for t, v in v_labels],
+            'town': t_labels,
+        }
+        if village_ECODE is not None:
+            E, _, e_labels = incidence(v_labels, [village_ECODE[v] for v in v_labels], v_labels)
+            self.matrices['electoral district'] = (E @ self.matrices['village']).tocsr()
+            self.labels['electoral district'] = e_labels
+
+    @classmethod
+    def from_pp_list(cls, target_county, target_town, PPIDs=None, village_ECODE=None, neighborhood_weights=None):
+        # PPIDs: polling places to include, all by default
+        # village_ECODE: {village: ECODE}, neighborhood_weights: {neighborhood: weight}
+        import pandas
+        df_pp = pandas.read_csv(f'pp_list/{target_county}_{target_town}_pp_list.csv')
+        if PPIDs is not None:
+            df_pp = df_pp[df_pp.PPID.isin(PPIDs)]
+        town = f'{target_county} {target_town}'
+        pp_rows = []
+        for idx, PPID, VILLNAME, NEIGHBORHOODS in df_pp.itertuples():
+            pp_rows.append((PPID, town, VILLNAME, parse_neighborhoods(NEIGHBORHOODS)))
+        if village_ECODE is not None:
+            village_ECODE = {(town, v): ECODE for v, ECODE in village_ECODE.items()}
+        if neighborhood_weights is not None:
+            neighborhood_weights = {(town, n): w for n, w in neighborhood_weights.items()}
+        return cls(pp_rows, village_ECODE, neighborhood_weights)
+
+    def aggregate(self, table, level):
+        # table: array of shape (len(polling places), ...)
+        if level == 'polling place':
+            return table
+        table = np.asarray(table)
+        shape = table.shape
+        result = self.matrices[level] @ table.reshape(shape[0], -1)
+        return result.reshape(-1, *shape[1:])
+
+    def aggregate_all(self, table):
+        return {level: self.aggregate(table, level) for level in LEVELS if level in self.labels}
+
+# %%
@@ -1,14 +1,21 @@
 # Distill legislator vote data of a town and save as csv files.
 
 # Requirements:
-#   <python> -m pip install pandas numpy
+#   <python> -m pip install pandas numpy scipy
 # Usage:
-#   <python> distill_legislators.py <county name> <town name>
+#   <python> distill_legislators.py <county name> <town name> [<option> ...]
 # Example usage:
 #   <python> distill_legislators.py 臺北市 南港區
 # Example output:
 #   data/臺北市_南港區_立委第4選區_村里.csv
 #   data/臺北市_南港區_立委第4選區_投開票所.csv
+# Options:
+# --apportion   Also compute the counts of villages from the counts of polling
+#               places apportioned by neighborhood membership (see `aggregate.py`),
+#               instead of the village rows of the votedata database, and save
+#               them as data/<county>_<town>_立委第<ECODE>選區_村里_按鄰分配.csv.
+#               The counts (including 選舉人數) may be fractional. Villages
+#               without polling places in pp_list are dropped with a warning.
 
 # Hierarchy of administrative and electroral divisions in the votedata database:
 #   PCODE   province            省, 直轄市
@@ -38,6 +45,7 @@
 #     Each division is contained in a single parent division.
 #   * The counts of some villages will not be accurate.
 #     E.g., the counts of 新城村 will not include the counts from PPID 224.
+#     Use --apportion to include them.
 
 # %% set target
 
@@ -48,6 +56,13 @@ argv = sys.argv
 if len(argv) >= 3:
     target_county = argv[1]
     target_town = argv[2]
+apportion = False
+for option in argv[3:]:
+    if option == '--apportion':
+        apportion = True
+    else:
+        print(f'unknown option: {option}')
+        exit()
 
 # %% find area codes
 
@@ -234,30 +249,17 @@ df_prof = pandas.read_csv('votedata/voteData/2024總統立委/區域立委/elpro
     })
 
 # load and process polling place names
+from aggregate import parse_neighborhoods
 class PollingPlaceName:
     def __init__(self, target_county, target_town):
         self.unknown_count = 0
         self.df_pp = pandas.read_csv(f'pp_list/{target_county}_{target_town}_pp_list.csv')
     @staticmethod
     def parse_list(NEIGHBORHOODS):
-        if NEIGHBORHOODS == '所有的鄰':
+        numbers = parse_neighborhoods(NEIGHBORHOODS)
+        if numbers is None:
             return '所有的鄰'
-        assert len(NEIGHBORHOODS) > 1, NEIGHBORHOODS
-        assert NEIGHBORHOODS[-1] == '鄰', NEIGHBORHOODS
-        nums = NEIGHBORHOODS[:-1].replace('、', ',').replace(', ', ',')
-        assert all(c in '0123456789-,' for c in nums), nums
-        nums = nums.split(',')
-        vill_list = []
-        for num in nums:
-            if '-' in num: # e.g., '9-12'
-                num = num.split('-')
-                assert len(num) == 2, num
-                start, stop = num
-                for n in range(int(start), int(stop) + 1):
-                    vill_list.append(n)
-            else: # e.g., '3'
-                vill_list.append(int(num))
-        return '_'.join([str(v) for v in vill_list])
+        return '_'.join([str(n) for n in numbers])
     def get(self, PPID):
         df = self.df_pp[self.df_pp.PPID == PPID]
         if len(df) == 0:
@@ -350,4 +352,34 @@ for ECODE in ECODEs: # some towns belong to multiple electoral districts
     df.to_csv(f'../data/{file_name}', index=False)
     print(f'generated file in data/: {file_name}')
 
+    # each village, apportioned from polling places
+    if apportion:
+        from aggregate import Aggregator
+        agg = Aggregator.from_pp_list(target_county, target_town, pps)
+        pp_idx = {PPID: p for p, PPID in enumerate(agg.labels['polling place'])}
+        pp_table = np.zeros((len(pp_idx), len(candidates) + 1), dtype=np.float64)
+        for PPID, row in zip(pps, table):
+            if PPID not in pp_idx:
+                print(f'warning: polling place (PPID={PPID}) not found in pp_list, excluded from villages')
+                continue
+            pp_table[pp_idx[PPID]] = row
+        table = agg.aggregate(pp_table, 'village')
+        vidx = {village_name: v for v, village_name in enumerate(agg.labels['village'])}
+        data = {'號次': CANIDs, '名字': CNAMEs, '政黨': PNAMEs}
+        columns = ['號次', '名字', '政黨']
+        for VCODE in villages: # in the order of the village file
+            village_name = df_village[df_village.VCODE==VCODE].NAME.iat[0]
+            if 'A' in VCODE: # special village of polling places across villages
+                print(f'village {village_name} (VCODE={VCODE}) skipped, its counts are apportioned into its villages')
+                continue
+            if village_name not in vidx:
+                print(f'warning: village {village_name} (VCODE={VCODE}) has no polling places in pp_list, dropped')
+                continue
+            data[village_name] = table[vidx[village_name]].round(2)
+            columns.append(village_name)
+        df = pandas.DataFrame(data, columns=columns)
+        file_name = f'{target_county}_{target_town}_立委第{ECODE}選區_村里_按鄰分配.csv'
+        df.to_csv(f'../data/{file_name}', index=False)
+        print(f'generated file in data/ with apportioned polling places: {file_name}')
+
 # %%
@@ -0,0 +1,284 @@
+# Distill all ballots of an election into a multi-election results cube.
+
+# The cube is a set of dense NumPy arrays saved in `data/cube/`:
+#   votes.npy   uint32  (election, ballot, division, party)
+#   stats.npy   uint32  (election, ballot, division, stat)
+#   labels.json         labels of each dimension, and the names of the
+#                       independent candidates of each (election, ballot)
+# The arrays are memory-mapped when loaded, so slicing a single election,
+# ballot, division or party reads only the needed pages from disk.
+
+# Divisions are villages (PPID == 0) and polling places (PPID != 0) of all
+# counties, labeled as '<PCODE>-<CCODE>-<TCODE>-<VCODE>-<PPID>' so that they
+# can be matched across elections and ballots. Village rows and polling place
+# rows share the division axis, and a village row is the sum of its polling
+# places, so summing over all divisions counts every vote twice. Select either
+# the PPID 0000 or the other divisions before summing.
+
+# Candidates are merged by party, so that ballots with different candidates
+# can be compared directly. Independent candidates (無黨籍及未經政黨推薦) are
+# pooled into a single party column, since local elections (e.g., 村里長) have
+# tens of thousands of them. Their names are kept in
+# labels['independents'][election][ballot].
+
+# Each run adds (or replaces) one election in the cube. Ballots are the
+# subdirectories of the election directory, e.g. 總統, 區域立委, 不分區政黨.
+
+# Requirements:
+#   <python> -m pip install pandas numpy
+# Usage:
+#   <python> results_cube.py <election name>
+# Example usage:
+#   <python> results_cube.py 2024總統立委
+# Example output:
+#   data/cube/votes.npy
+#   data/cube/stats.npy
+#   data/cube/labels.json
+# Example usage as a module:
+#   import sys; sys.path.append('../distill_data')
+#   from results_cube import ResultsCube
+#   cube = ResultsCube.load()
+#   cube.sel('2024總統立委', '總統', party='民主進步黨') # votes of each division
+#   cube.swing(('2024總統立委', '不分區政黨'), ('2024總統立委', '總統')) # share differences
+
+import os, json
+import numpy as np
+
+CUBE_DIR = '../data/cube'
+STATS = ('VALIC', 'INVAC', 'TVOTC', 'ELIGC') # valid, invalid, total vote count, eligible count
+INDEPENDENT = '無黨籍及未經政黨推薦'
+
+def division_label(PCODE, CCODE, TCODE, VCODE, PPID):
+    return f'{PCODE:02d}-{CCODE:03d}-{TCODE:03d}-{VCODE}-{PPID:04d}'
+
+# %% query
+
+class ResultsCube:
+    def __init__(self, labels, votes, stats):
+        self.labels = labels
+        self.votes = votes
+        self.stats = stats
+        self.index = {dim: {label: i for i, label in enumerate(labels[dim])} for dim in
+            ('elections', 'ballots', 'divisions', 'parties', 'stats')}
+
+    @classmethod
+    def load(cls, cube_dir=CUBE_DIR, mmap_mode='r'):
+        with open(f'{cube_dir}/labels.json', encoding='utf-8') as f:
+            labels = json.load(f)
+        votes = np.load(f'{cube_dir}/votes.npy', mmap_mode=mmap_mode)
+        stats = np.load(f'{cube_dir}/stats.npy', mmap_mode=mmap_mode)
+        labels.setdefault('independents', {})
+        return cls(labels, votes, stats)
+
+    @classmethod
+    def empty(cls):
+        labels = {'elections': [], 'ballots': [], 'divisions': [], 'division_names': [],
+            'parties': [], 'stats': list(STATS), 'independents': {}}
+        return cls(labels, np.zeros((0, 0, 0, 0), np.uint32), np.zeros((0, 0, 0, len(STATS)), np.uint32))
+
+    def dump(self, cube_dir=CUBE_DIR):
+        os.makedirs(cube_dir, exist_ok=True)
+        # write to temporary files first, since the old arrays may be memory-mapped
+        np.save(f'{cube_dir}/votes.tmp.npy', self.votes)
+        np.save(f'{cube_dir}/stats.tmp.npy', self.stats)
+        os.replace(f'{cube_dir}/votes.tmp.npy', f'{cube_dir}/votes.npy')
+        os.replace(f'{cube_dir}/stats.tmp.npy', f'{cube_dir}/stats.npy')
+        with open(f'{cube_dir}/labels.json', 'w', encoding='utf-8') as f:
+            json.dump(self.labels, f, ensure_ascii=False)
+
+    def _key(self, dim, label):
+        # None selects the whole dimension, a list selects several labels
+        if label is None:
+            return slice(None)
+        if isinstance(label, (list, tuple)):
+            return [self.index[dim][l] for l in label]
+        return self.index[dim][label]
+
+    def sel(self, election=None, ballot=None, division=None, party=None):
+        return self.votes[
+            self._key('elections', election),
+            self._key('ballots', ballot),
+            self._key('divisions', division),
+            self._key('parties', party)]
+
+    def stat(self, name, election=None, ballot=None, division=None):
+        return self.stats[
+            self._key('elections', election),
+            self._key('ballots', ballot),
+            self._key('divisions', division),
+            self.index['stats'][name]]
+
+    def shares(self, election=None, ballot=None):
+        # vote shares of each party, i.e., votes / valid count (0 if no data)
+        votes = self.sel(election, ballot).astype(np.float64)
+        valid = self.stat('VALIC', election, ballot).astype(np.float64)[..., None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shares = votes / valid
+        return np.nan_to_num(shares, copy=False, nan=0.0, posinf=0.0)
+
+    def swing(self, a, b):
+        # Vote share differences a - b of each (division, party), where a and b
+        # are (election, ballot) pairs. Divisions without data in either a or b
+        # are set to NaN.
+        shares_a = self.shares(*a)
+        shares_b = self.shares(*b)
+        missing = (self.stat('VALIC', *a) == 0) | (self.stat('VALIC', *b) == 0)
+        swing = shares_a - shares_b
+        swing[missing] = np.nan
+        return swing
+
+    def turnout(self, election=None, ballot=None):
+        total = self.stat('TVOTC', election, ballot).astype(np.float64)
+        eligible = self.stat('ELIGC', election, ballot).astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            turnout = total / eligible
+        return np.nan_to_num(turnout, copy=False, nan=0.0, posinf=0.0)
+
+    def merge(self, election, ballots):
+        # Return a new cube with `election` replaced by `ballots`, a dict of
+        # {ballot: (divisions, division_names, parties, votes, stats, independents)}.
+        labels = {dim: list(self.labels[dim]) for dim in self.labels if dim != 'independents'}
+        labels['independents'] = {**self.labels['independents'],
+            election: {ballot: values[5] for ballot, values in ballots.items()}}
+        if election not in labels['elections']:
+            labels['elections'].append(election)
+        for ballot, (divisions, division_names, parties, votes, stats, independents) in ballots.items():
+            if ballot not in labels['ballots']:
+                labels['ballots'].append(ballot)
+            known = set(labels['divisions'])
+            for division, name in zip(divisions, division_names):
+                if division not in known:
+                    labels['divisions'].append(division)
+                    labels['division_names'].append(name)
+                    known.add(division)
+            known = set(labels['parties'])
+            labels['parties'] += [p for p in parties if p not in known]
+
+        shape = [len(labels[dim]) for dim in ('elections', 'ballots', 'divisions', 'parties')]
+        cube = ResultsCube(labels, np.zeros(shape, np.uint32), np.zeros(shape[:3] + [len(STATS)], np.uint32))
+        e, b, d, p = self.votes.shape
+        cube.votes[:e, :b, :d, :p] = self.votes
+        cube.stats[:e, :b, :d] = self.stats
+        e = cube.index['elections'][election]
+        cube.votes[e] = 0
+        cube.stats[e] = 0
+        for ballot, (divisions, division_names, parties, votes, stats, independents) in ballots.items():
+            b = cube.index['ballots'][ballot]
+            d = np.array([cube.index['divisions'][l] for l in divisions], dtype=np.intp)
+            p = np.array([cube.index['parties'][l] for l in parties], dtype=np.intp)
+            cube.votes[e, b, d[:, None], p[None, :]] = votes
+            cube.stats[e, b, d] = stats
+        return cube
+
+# %% distill
+
+def read_ballot(ballot_dir):
+    import pandas
+    code_names = ['PCODE', 'CCODE', 'ECODE', 'TCODE', 'VCODE']
+    code_dtypes = {'PCODE': 'uint16', 'CCODE': 'uint16', 'ECODE': 'uint16', 'TCODE': 'uint16', 'VCODE': 'string'}
+
+    # division names: elbese.csv for elections with electoral districts, elbase.csv otherwise
+    base_path = f'{ballot_dir}/elbese.csv'
+    if not os.path.exists(base_path):
+        base_path = f'{ballot_dir}/elbase.csv'
+    df_base = pandas.read_csv(base_path, names=code_names + ['NAME'], dtype={**code_dtypes, 'NAME': 'string'})
+    df_base = df_base.drop_duplicates(['PCODE', 'CCODE', 'TCODE', 'VCODE'])
+    county_name = {}
+    town_name = {}
+    village_name = {}
+    for row in df_base.itertuples():
+        if row.TCODE == 0 and row.VCODE == '0000':
+            county_name[(row.PCODE, row.CCODE)] = row.NAME
+        elif row.VCODE == '0000':
+            town_name[(row.PCODE, row.CCODE, row.TCODE)] = row.NAME
+        else:
+            village_name[(row.PCODE, row.CCODE, row.TCODE, row.VCODE)] = row.NAME
+
+    # party
+    df_paty = pandas.read_csv(f'{ballot_dir}/elpaty.csv', names=['PARID', 'PNAME'],
+        dtype={'PARID': 'uint16', 'PNAME': 'string'})
+    party = dict(zip(df_paty.PARID, df_paty.PNAME))
+
+    # candidate -> party label
+    df_cand = pandas.read_csv(f'{ballot_dir}/elcand.csv', names=code_names + [
+            'CANID', 'CNAME', 'PARID', 'GENDR', 'BDATE', 'CAAGE', 'BPLAC', 'EDBAC', 'ISINC', 'ELECT', 'ISASS'],
+        dtype={**code_dtypes, 'CANID': 'uint16', 'CNAME': 'string', 'PARID': 'uint16', 'ISASS': 'string'},
+        keep_default_na=False)
+    df_cand = df_cand[df_cand.ISASS != 'Y'] # skip running mates, e.g., vice presidents
+    cand_party = {}
+    independents = set()
+    for row in df_cand.itertuples():
+        PNAME = party.get(row.PARID, row.CNAME) # party-list candidates are parties themselves
+        if PNAME == INDEPENDENT:
+            independents.add(row.CNAME)
+        if row.PCODE == 0: # nationwide candidates
+            cand_party[row.CANID] = PNAME
+        else:
+            cand_party[(row.PCODE, row.CCODE, row.ECODE, row.CANID)] = PNAME
+
+    # results: village and polling place rows only
+    df_tks = pandas.read_csv(f'{ballot_dir}/elctks.csv', names=code_names + [
+            'PPID', 'CANID', 'VOTEC', 'VOTER', 'ELECT'],
+        dtype={**code_dtypes, 'PPID': 'uint16', 'CANID': 'uint16', 'VOTEC': 'uint32'},
+        usecols=code_names + ['PPID', 'CANID', 'VOTEC'])
+    df_tks = df_tks[df_tks.VCODE != '0000']
+    df_prof = pandas.read_csv(f'{ballot_dir}/elprof.csv', names=code_names + [
+            'PPID', 'VALIC', 'INVAC', 'TVOTC', 'ELIGC', 'POPUC', 'CANDC', 'ELECC',
+            'CANDCM', 'CANDCF', 'ELECCM', 'ELECCF', 'ELIGR', 'TVOTR', 'ELECR'],
+        dtype={**code_dtypes, 'PPID': 'uint16', **{s: 'uint32' for s in STATS}},
+        usecols=code_names + ['PPID', *STATS])
+    df_prof = df_prof[df_prof.VCODE != '0000']
+
+    # labels
+    keys = sorted(set(zip(df_prof.PCODE, df_prof.CCODE, df_prof.TCODE, df_prof.VCODE, df_prof.PPID)))
+    divisions = [division_label(*key) for key in keys]
+    division_names = []
+    for PCODE, CCODE, TCODE, VCODE, PPID in keys:
+        name = ' '.join([county_name.get((PCODE, CCODE), ''), town_name.get((PCODE, CCODE, TCODE), ''),
+            village_name.get((PCODE, CCODE, TCODE, VCODE), '')])
+        division_names.append(f'{name} {PPID:04d}' if PPID != 0 else name)
+    parties = sorted(set(cand_party.values()))
+    didx = {key: d for d, key in enumerate(keys)}
+    pidx = {label: p for p, label in enumerate(parties)}
+
+    # dense arrays
+    votes = np.zeros((len(keys), len(parties)), np.uint32)
+    d = [didx[key] for key in zip(df_tks.PCODE, df_tks.CCODE, df_tks.TCODE, df_tks.VCODE, df_tks.PPID)]
+    p = []
+    for PCODE, CCODE, ECODE, CANID in zip(df_tks.PCODE, df_tks.CCODE, df_tks.ECODE, df_tks.CANID):
+        label = cand_party.get(CANID) or cand_party[(PCODE, CCODE, ECODE, CANID)]
+        p.append(pidx[label])
+    np.add.at(votes, (np.array(d, dtype=np.intp), np.array(p, dtype=np.intp)), df_tks.VOTEC.to_numpy())
+    stats = np.zeros((len(keys), len(STATS)), np.uint32)
+    d = [didx[key] for key in zip(df_prof.PCODE, df_prof.CCODE, df_prof.TCODE, df_prof.VCODE, df_prof.PPID)]
+    stats[d] = df_prof[list(STATS)].to_numpy()
+    return divisions, division_names, parties, votes, stats, sorted(independents)
+
+if __name__ == '__main__':
+    import sys
+    argv = sys.argv
+    assert len(argv) >= 2, argv
+    election = argv[1]
+    election_dir = f'votedata/voteData/{election}'
+    ballots = {}
+    for ballot in sorted(os.listdir(election_dir)):
+        ballot_dir = f'{election_dir}/{ballot}'
+        if not os.path.isdir(ballot_dir):
+            continue
+        if not os.path.exists(f'{ballot_dir}/elctks.csv'):
+            print(f'skipped {ballot_dir}: elctks.csv not found')
+            continue
+        ballots[ballot] = read_ballot(ballot_dir)
+        divisions, division_names, parties, votes, stats, independents = ballots[ballot]
+        print(f'{election} {ballot}: {len(divisions)} divisions, {len(parties)} parties, '
+            f'{len(independents)} independent candidates')
+
+    if os.path.exists(f'{CUBE_DIR}/labels.json'):
+        cube = ResultsCube.load()
+    else:
+        cube = ResultsCube.empty()
+    cube = cube.merge(election, ballots)
+    cube.dump()
+    print(f'generated files in {CUBE_DIR}: votes.npy {cube.votes.shape}, stats.npy {cube.stats.shape}, labels.json')
+
+# %%
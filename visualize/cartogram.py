@@ -0,0 +1,323 @@
+# Diffusion cartograms of shapes, sized by eligible voters or votes.
+
+# Geographic area is misleading in vote maps: sparsely populated mountain
+# neighborhoods dominate the image, while dense polling places are tiny. This
+# warps the shapes of a set of towns so that the area of each polling place is
+# proportional to its weight, with the diffusion method of Gastner and Newman
+# (PNAS 101, 7499, 2004):
+# 1. Rasterize the density (weight per area) of the polling places onto a
+#    grid, found with the spatial index of `collect_shapes/shape_index.py`.
+#    The rest of the grid (sea) gets the mean density, so the map keeps its size.
+#    Polling places without weight, e.g., without votes for a candidate, get a
+#    small floor density instead of 0, where the velocity below is undefined.
+# 2. Let the density diffuse. With reflecting boundaries, the solution at any
+#    time is a cosine series, computed with NumPy FFTs of the mirrored grid.
+# 3. Move the grid points along the velocity field -grad(density) / density
+#    until the density is uniform.
+# 4. Displace all polygon vertices, arcs and centroids in one vectorized
+#    bilinear interpolation of the displaced grid points, so shared
+#    boundaries stay shared.
+# As the density is blurred and sampled on a grid, a single pass leaves some
+# error in the areas of small polling places, so the steps are repeated on the
+# result (3 iterations by default). For 南港區 and 內湖區, this reduces the
+# coefficient of variation of area / eligible voters from about 3.5 to 0.08,
+# in about 25 seconds.
+
+# Weights come from the `投開票所` data files of the towns (`data/<county>_<town>_*_投開票所.csv`),
+# by the row of the given name: `選舉人數` (ELIGC, eligible voters) by default, or a candidate.
+# A polling place's weight is spread evenly over its neighborhoods.
+
+# The result is cached per (town set, weighting) in `cartograms/`, and rebuilt
+# if the shape, topology or data files change:
+#   cartograms/臺北市_內湖區+臺北市_南港區_選舉人數.pkl
+#   {'digest': ..., 'shapes': {(county, town): (towns, villages, neighborhoods)},
+#    'topology': {(county, town): topology or None}}
+# The warped shapes and topologies have the same format as the originals.
+
+# Requirements:
+#   <python> -m pip install pandas numpy
+# Usage (build the cartogram of a set of towns; `export.py --cartogram` does this too):
+#   <python> cartogram.py <county>_<town> [<county>_<town> ...] [--weight=<row name>] [--grid=<size>]
+# Example usage:
+#   <python> cartogram.py 臺北市_南港區 臺北市_內湖區
+# Example output:
+#   cartograms/臺北市_內湖區+臺北市_南港區_選舉人數.pkl
+# Example usage as a module (see `export.py`):
+#   from cartogram import load_cartogram
+#   cartogram = load_cartogram([('臺北市', '南港區'), ('臺北市', '內湖區')])
+#   towns, villages, neighborhoods = cartogram['shapes'][('臺北市', '南港區')]
+
+import sys, os, glob, pickle, hashlib, pandas
+import numpy as np
+sys.path.append('../collect_shapes')
+from shape_index import ShapeIndex
+sys.path.append('../distill_data')
+from aggregate import parse_neighborhood_name
+
+CARTOGRAM_DIR = 'cartograms'
+GRID = 512 # cells along the longer side of the grid
+PADDING = 0.5 # sea around the map, relative to its size
+BLUR = 1.0 # width of the Gaussian blur of the density, in cells
+MAX_STEP = 0.5 # maximum displacement per time step, in cells
+ITERATIONS = 3 # each iteration diffuses the density left by the previous one
+DENSITY_FLOOR = 0.01 # minimum density of polling places, relative to the mean
+COS_LAT = np.cos(25 / 180 * np.pi) # latitude is about 25 degrees North at Taipei
+
+def cartogram_path(county_towns, weighting):
+    keys = sorted(f'{county}_{town}' for county, town in county_towns)
+    return f'{CARTOGRAM_DIR}/{"+".join(keys)}_{weighting}.pkl'
+
+def input_paths(county, town):
+    shape_path = f'../shapes/{county}_{town}.pkl'
+    topology_path = f'../shapes/{county}_{town}.topology.pkl'
+    data_paths = sorted(glob.glob(f'../data/{county}_{town}_*_投開票所.csv'))
+    return shape_path, topology_path, data_paths
+
+def input_digest(county_towns, weighting, grid, iterations):
+    h = hashlib.sha256(f'{weighting} {grid} {iterations}'.encode())
+    for county, town in sorted(county_towns):
+        shape_path, topology_path, data_paths = input_paths(county, town)
+        for path in [shape_path, topology_path, *data_paths]:
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    h.update(f.read())
+    return h.hexdigest()
+
+# %% density
+
+def read_weights(data_paths, weighting):
+    # {polling place: weight} of the data files, e.g., {'南港里_2_3_4_5_6_7': 956, ...}
+    weights = {}
+    for path in data_paths:
+        df = pandas.read_csv(path)
+        rows = df.index[df['名字'] == weighting]
+        assert len(rows) == 1, f'{weighting} not found in {path}'
+        for pp_name, weight in df.iloc[rows[0], 3:].items():
+            weights[pp_name] = weights.get(pp_name, 0) + float(weight)
+    return weights
+
+def rasterize(grid_points, towns):
+    # density at grid_points (in longitudes and latitudes), where towns is a
+    # list of (shapes, weights), and the total weight of the polling places
+    pp_of_point = np.full(len(grid_points), -1, dtype=np.intp)
+    pp_weights = []
+    pp_centroids = []
+    for shapes, weights in towns:
+        neighborhoods = shapes[2]
+        n_pp = {}
+        for pp_name, weight in weights.items():
+            n_names = [n for n in parse_neighborhood_name(pp_name, neighborhoods)[1] if n in neighborhoods]
+            if len(n_names) == 0:
+                print(f'warning: no neighborhoods found for {pp_name}')
+                continue
+            for n_name in n_names:
+                n_pp[n_name] = len(pp_weights)
+            pp_weights.append(weight)
+            pp_centroids.append(neighborhoods[n_names[0]][1])
+        index = ShapeIndex(shapes).neighborhoods
+        pp_of_id = np.array([n_pp.get(n_name, -1) for n_name in index.names] + [-1], dtype=np.intp)
+        pp = pp_of_id[index.query_point_ids(grid_points)] # -1 indexes the trailing -1
+        pp_of_point[pp >= 0] = pp[pp >= 0]
+    pp_weights = np.array(pp_weights)
+
+    # spread the weight of each polling place over its points
+    cells = np.bincount(pp_of_point[pp_of_point >= 0], minlength=len(pp_weights))
+    density = np.zeros(len(grid_points))
+    inside = pp_of_point >= 0
+    density[inside] = (pp_weights / np.maximum(cells, 1))[pp_of_point[inside]]
+    # polling places smaller than a cell go to the cell nearest to their centroid
+    for pp in np.flatnonzero(cells == 0):
+        p = np.argmin(((grid_points - pp_centroids[pp]) ** 2).sum(axis=1))
+        density[p] += pp_weights[pp]
+        inside[p] = True
+    mean = density[inside].sum() / inside.sum()
+    density[inside] = np.maximum(density[inside], DENSITY_FLOOR * mean)
+    density[~inside] = mean # sea
+    return density
+
+# %% diffusion
+
+class Diffusion:
+    def __init__(self, density, blur=BLUR):
+        # density: array of shape (ny, nx) at cell centers
+        self.ny, self.nx = density.shape
+        mirrored = np.concatenate([density, density[::-1]], axis=0)
+        mirrored = np.concatenate([mirrored, mirrored[:, ::-1]], axis=1)
+        self.ky = 2 * np.pi * np.fft.fftfreq(2 * self.ny)[:, None]
+        self.kx = 2 * np.pi * np.fft.rfftfreq(2 * self.nx)[None, :]
+        self.k2 = self.kx ** 2 + self.ky ** 2
+        self.spectrum = np.fft.rfft2(mirrored) * np.exp(-self.k2 * blur ** 2 / 2)
+        self.rho_min = DENSITY_FLOOR * density.mean() # against round-off near 0
+
+    def velocity(self, t):
+        # velocity field (vx, vy) = -grad(density) / density at time t
+        s = self.spectrum * np.exp(-self.k2 * t)
+        shape = (2 * self.ny, 2 * self.nx)
+        rho = np.maximum(np.fft.irfft2(s, shape)[:self.ny, :self.nx], self.rho_min)
+        vx = -np.fft.irfft2(1j * self.kx * s, shape)[:self.ny, :self.nx] / rho
+        vy = -np.fft.irfft2(1j * self.ky * s, shape)[:self.ny, :self.nx] / rho
+        return vx, vy
+
+    def end_time(self, tolerance=1e-4):
+        # time when the slowest mode has decayed to tolerance
+        k = np.pi / max(self.nx, self.ny)
+        return np.log(1 / tolerance) / k ** 2
+
+def interpolate(field, points, offset):
+    # bilinear interpolation of field (ny, nx, ...) at points (N, 2) in cell
+    # units, where field[j, i] is at (i + offset, j + offset)
+    ny, nx = field.shape[:2]
+    x = np.clip(points[:, 0] - offset, 0, nx - 1)
+    y = np.clip(points[:, 1] - offset, 0, ny - 1)
+    i = np.minimum(x.astype(np.intp), nx - 2)
+    j = np.minimum(y.astype(np.intp), ny - 2)
+    fx, fy = x - i, y - j
+    if field.ndim == 3:
+        fx, fy = fx[:, None], fy[:, None]
+    return (field[j, i] * (1 - fx) * (1 - fy) + field[j, i + 1] * fx * (1 - fy) +
+        field[j + 1, i] * (1 - fx) * fy + field[j + 1, i + 1] * fx * fy)
+
+def displace_grid(diffusion):
+    # positions (ny + 1, nx + 1, 2) of the grid points after diffusion, in cell units
+    ny, nx = diffusion.ny, diffusion.nx
+    gx, gy = np.meshgrid(np.arange(nx + 1, dtype=np.float64), np.arange(ny + 1, dtype=np.float64))
+    points = np.stack([gx.ravel(), gy.ravel()], axis=1)
+    def velocity(points, t):
+        vx, vy = diffusion.velocity(t)
+        return np.stack([interpolate(vx, points, 0.5), interpolate(vy, points, 0.5)], axis=1)
+    t, dt, steps = 0.0, 1e-2, 0
+    t_end = diffusion.end_time()
+    while t < t_end:
+        # midpoint method with a step size limited by MAX_STEP
+        v1 = velocity(points, t)
+        dt = min(dt * 2, MAX_STEP / max(np.abs(v1).max(), 1e-12), t_end - t)
+        v2 = velocity(points + v1 * dt / 2, t + dt / 2)
+        points += v2 * dt
+        t += dt
+        steps += 1
+    print(f'diffusion finished in {steps} steps')
+    return points.reshape(ny + 1, nx + 1, 2)
+
+# %% build
+
+def collect_vertices(shapes, topology):
+    # all vertices of shapes and topology as an (N, 2) array, and a function
+    # rebuilding shapes and topology from the displaced vertices
+    pieces = []
+    for features in shapes:
+        for parts, centroid in features.values():
+            pieces += parts
+            pieces.append([centroid])
+    if topology is not None:
+        for level in topology.values():
+            pieces += level['arcs']
+    sizes = [len(piece) for piece in pieces]
+    vertices = np.array([v for piece in pieces for v in piece], dtype=np.float64).reshape(-1, 2)
+
+    def rebuild(displaced):
+        chunks = iter(np.split(displaced, np.cumsum(sizes)[:-1]))
+        def points():
+            return [tuple(v) for v in next(chunks).tolist()]
+        new_shapes = []
+        for features in shapes:
+            new_features = {}
+            for name, (parts, centroid) in features.items():
+                new_parts = [points() for part in parts]
+                new_features[name] = (new_parts, points()[0])
+            new_shapes.append(new_features)
+        new_topology = None
+        if topology is not None:
+            new_topology = {}
+            for level_name, level in topology.items():
+                new_topology[level_name] = {**level, 'arcs': [points() for arc in level['arcs']]}
+        return tuple(new_shapes), new_topology
+
+    return vertices, rebuild
+
+def build_cartogram(county_towns, weighting='選舉人數', grid=GRID, iterations=ITERATIONS):
+    towns = []
+    for county, town in county_towns:
+        shape_path, topology_path, data_paths = input_paths(county, town)
+        assert len(data_paths) > 0, f'no 投開票所 data files of {county} {town} in ../data/'
+        with open(shape_path, 'rb') as f:
+            shapes = pickle.load(f)
+        topology = None
+        if os.path.exists(topology_path):
+            with open(topology_path, 'rb') as f:
+                topology = pickle.load(f)
+        towns.append((shapes, topology, read_weights(data_paths, weighting)))
+    total = sum(sum(weights.values()) for shapes, topology, weights in towns)
+    assert total > 0, f'the total {weighting} of {county_towns} is {total}, nothing to size the polling places by'
+
+    collected = [collect_vertices(shapes, topology) for shapes, topology, weights in towns]
+    vertices = np.concatenate([v for v, rebuild in collected]) * [COS_LAT, 1]
+    offsets = np.cumsum([0] + [len(v) for v, rebuild in collected])
+    current = [shapes for shapes, topology, weights in towns]
+    for iteration in range(iterations):
+        # grid covering the towns with padding, with square cells in projected coordinates
+        lo, hi = vertices.min(axis=0), vertices.max(axis=0)
+        size = (hi - lo).max()
+        cell = size * (1 + 2 * PADDING) / grid
+        nx, ny = np.ceil((hi - lo + 2 * PADDING * size) / cell).astype(int)
+        origin = (lo + hi) / 2 - np.array([nx, ny]) * cell / 2
+        print(f'iteration {iteration + 1}: grid of {nx} x {ny} cells')
+
+        # density at cell centers
+        cx, cy = np.meshgrid(np.arange(nx) + 0.5, np.arange(ny) + 0.5)
+        centers = (np.stack([cx.ravel(), cy.ravel()], axis=1) * cell + origin) / [COS_LAT, 1]
+        density = rasterize(centers, [(shapes, weights) for shapes, (s, t, weights) in zip(current, towns)])
+        grid_points = displace_grid(Diffusion(density.reshape(ny, nx)))
+
+        # displace all vertices at once
+        vertices = interpolate(grid_points, (vertices - origin) / cell, 0.0) * cell + origin
+        current = [rebuild(vertices[start:stop] / [COS_LAT, 1])[0]
+            for (v, rebuild), start, stop in zip(collected, offsets[:-1], offsets[1:])]
+
+    displaced = vertices / [COS_LAT, 1]
+    result = {'shapes': {}, 'topology': {}}
+    for (county, town), (v, rebuild), start, stop in zip(county_towns, collected, offsets[:-1], offsets[1:]):
+        shapes, topology = rebuild(displaced[start:stop])
+        result['shapes'][(county, town)] = shapes
+        result['topology'][(county, town)] = topology
+    return result
+
+def load_cartogram(county_towns, weighting='選舉人數', grid=GRID, iterations=ITERATIONS):
+    # the cached cartogram of the towns, built if missing or outdated
+    path = cartogram_path(county_towns, weighting)
+    digest = input_digest(county_towns, weighting, grid, iterations)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            cartogram = pickle.load(f)
+        if cartogram['digest'] == digest:
+            print(f'read cartogram file: {path}')
+            return cartogram
+    cartogram = build_cartogram(county_towns, weighting, grid, iterations)
+    cartogram['digest'] = digest
+    os.makedirs(CARTOGRAM_DIR, exist_ok=True)
+    with open(path, 'wb') as f:
+        pickle.dump(cartogram, f)
+    print(f'generated file: {path}')
+    return cartogram
+
+# %% build the cartogram of a set of towns
+
+if __name__ == '__main__':
+    argv = sys.argv
+    assert len(argv) >= 2, argv
+    county_towns = []
+    weighting = '選舉人數'
+    grid = GRID
+    for arg in argv[1:]:
+        if arg.startswith('--weight='):
+            weighting = arg[9:]
+        elif arg.startswith('--grid='):
+            grid = int(arg[7:])
+        elif arg.startswith('--'):
+            print(f'unknown option: {arg}')
+            exit()
+        else:
+            county, town = arg.split('_')
+            county_towns.append((county, town))
+    load_cartogram(county_towns, weighting, grid)
+
+# %%
@@ -3,27 +3,93 @@
 # Requirements:
 #   <python> -m pip install pandas numpy matplotlib
 # Usage:
-#   <python> export.py <path prefix> <RGB name 0> [<RGB name 1> ...]
+#   <python> export.py <path prefix> <RGB name 0> [<RGB name 1> ...] [<option> ...]
 # Example usage:
 #   <python> export.py ../output/港湖 南港 內湖
+#   <python> export.py ../output/港湖_poster 南港 內湖 --poster=20000
 # Example output:
 #   ../output/港湖.png
 
+# Options:
+# --poster=<size>   Export a poster of <size> x <size> pixels instead of the
+#                   default 1000 x 1000 pixels. The poster is rendered tile by
+#                   tile, each tile containing only the features in its bbox
+#                   (found with the spatial index of `collect_shapes/shape_index.py`),
+#                   and streamed into a PNG file strip by strip, so that memory
+#                   usage does not grow with the size of the poster.
+# --tile=<size>     Set the size of the tiles of a poster, 1024 by default.
+# --uncertainty=saturation
+#                   Reduce the saturation of divisions by their uncertainty
+#                   (the `不確定性` column added by `select_data.py --uncertainty`,
+#                   the width of the widest 95% confidence interval of the
+#                   vote shares and the participation rate), keeping their
+#                   brightness (participation rate).
+# --uncertainty=hatch
+#                   Hatch divisions by their uncertainty instead, denser for
+#                   more uncertain divisions.
+# --uncertainty-range=<low>,<high>
+#                   Uncertainties of full saturation (no hatch) and of zero
+#                   saturation (the densest hatch), with '/', '//' and '///'
+#                   from 1/2, 3/4 and all of the way from <low> to <high>.
+#                   By default, the 5th and 95th percentiles of the
+#                   uncertainties of all divisions drawn, as confidence
+#                   intervals are similar in absolute terms (e.g., 0.06-0.08
+#                   for all polling places of 南港區), so that the less
+#                   certain divisions stand out relative to the others.
+# --cartogram[=<row name>]
+#                   Draw a cartogram, where the area of each polling place is
+#                   proportional to its eligible voters (選舉人數), or to the
+#                   votes of the named candidate. The cartogram is built once
+#                   per set of towns and weighting, and cached in `cartograms/`
+#                   (see `cartogram.py`).
+
 # %% read files
 
 import sys, pandas, pickle
+sys.path.append('../distill_data')
+from aggregate import parse_neighborhood_name
 argv = sys.argv
 assert len(argv) >= 3, argv
 out_path_prefix = argv[1]
-RGB_names = argv[2:]
+RGB_names = []
+poster_size = None
+tile_size = 1024
+uncertainty_mode = None
+uncertainty_range = None
+cartogram_weighting = None
+for arg in argv[2:]:
+    if arg.startswith('--poster='):
+        poster_size = int(arg[9:])
+    elif arg.startswith('--tile='):
+        tile_size = int(arg[7:])
+    elif arg in ('--uncertainty=saturation', '--uncertainty=hatch'):
+        uncertainty_mode = arg[14:]
+    elif arg.startswith('--uncertainty-range='):
+        uncertainty_range = [float(u) for u in arg[20:].split(',')]
+        assert len(uncertainty_range) == 2 and uncertainty_range[0] < uncertainty_range[1], arg
+    elif arg == '--cartogram':
+        cartogram_weighting = '選舉人數'
+    elif arg.startswith('--cartogram='):
+        cartogram_weighting = arg[12:]
+    elif arg.startswith('--'):
+        print(f'unknown option: {arg}')
+        exit()
+    else:
+        RGB_names.append(arg)
+assert len(RGB_names) >= 1, argv
 
 df_list = []
 shapes_list = []
+topology_list = []
 shape_paths = []
+county_towns = []
 town_names = []
 for RGB_name in RGB_names:
     path = f'rgb/{RGB_name}.csv'
     df = pandas.read_csv(path)
+    if uncertainty_mode is not None and '不確定性' not in df.columns:
+        print(f'{path} has no uncertainty, please run `select_data.py` with --uncertainty')
+        exit()
     df_list.append(df)
     county, town, div_type = df.columns[0].split(' ')
     print('-' * 80)
@@ -36,6 +102,12 @@ for RGB_name in RGB_names:
         shapes = pickle.load(f)
     shapes_list.append(shapes)
     shape_paths.append(path)
+    try: # shared arcs, see `collect_shapes/topology.py`
+        with open(path[:-len('.pkl')] + '.topology.pkl', 'rb') as f:
+            topology_list.append(pickle.load(f))
+    except FileNotFoundError:
+        topology_list.append(None)
+    county_towns.append((county, town))
     town_names.append(town)
     print(f'read shape file: {path}')
     print(f'  {len(shapes[0])} towns')
@@ -43,6 +115,13 @@ for RGB_name in RGB_names:
     print(f'  {len(shapes[2])} neighborhoods')
 print('-' * 80)
 
+if cartogram_weighting is not None:
+    from cartogram import load_cartogram
+    cartogram = load_cartogram(county_towns, cartogram_weighting)
+    shapes_list = [cartogram['shapes'][county_town] for county_town in county_towns]
+    topology_list = [cartogram['topology'][county_town] for county_town in county_towns]
+    print('-' * 80)
+
 # %% export to image
 
 import numpy as np
@@ -56,93 +135,266 @@ plt.rcParams['font.sans-serif'] = 'Noto Sans TC'
 from matplotlib.path import Path
 from matplotlib.patches import PathPatch
 from matplotlib.cm import ScalarMappable
+from matplotlib.collections import LineCollection
 
-def parse_neighborhood_name(pp_name):
-    v_name_list = []
-    n_name_list = []
-    for village in pp_name.split(' '):
-        village = village.split('_')
-        v_name = village[0]
-        v_name_list.append(v_name)
-        for n_number in village[1:]:
-            n_name = f'{v_name}{n_number}鄰'
-            n_name_list.append(n_name)
-    return v_name_list, n_name_list
+def boundary_lines(features, names, topology_level):
+    # lines of the boundaries of the named features, each shared arc only once
+    if topology_level is None:
+        return [part for name in names for part in features[name][0]]
+    fidx = {name: f for f, name in enumerate(topology_level['names'])}
+    arc_ids = set()
+    for name in names:
+        for part in topology_level['parts'][fidx[name]]:
+            arc_ids.update(a if a >= 0 else ~a for a in part)
+    return [topology_level['arcs'][a] for a in sorted(arc_ids)]
 
-# create figure
-fig = plt.figure(figsize=(10, 10), dpi=100)
-ax = fig.add_axes(plt.Axes(fig, (0, 0, 1, 1)))
-ax.get_xaxis().set_visible(False)
-ax.get_yaxis().set_visible(False)
-ax.spines['top'].set_visible(False)
-ax.spines['right'].set_visible(False)
-ax.spines['bottom'].set_visible(False)
-ax.spines['left'].set_visible(False)
-ax.set_facecolor('0.8')
-ax.set_aspect(aspect, 'datalim')
-ax.margins(x=0.01, y=0.01)
+def create_map_axes(fig):
+    ax = fig.add_axes(plt.Axes(fig, (0, 0, 1, 1)))
+    ax.get_xaxis().set_visible(False)
+    ax.get_yaxis().set_visible(False)
+    ax.spines['top'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    ax.spines['bottom'].set_visible(False)
+    ax.spines['left'].set_visible(False)
+    ax.set_facecolor('0.8')
+    return ax
+
+UNCERTAINTY_PERCENTILES = (5, 95) # default uncertainty range
+HATCH_LEVELS = [(1, '///'), (0.75, '//'), (0.5, '/')] # (minimum position in the uncertainty range, hatch)
+
+if uncertainty_mode is not None and uncertainty_range is None:
+    uncertainty_range = np.percentile(pandas.concat([df['不確定性'] for df in df_list]), UNCERTAINTY_PERCENTILES)
+    print(f'uncertainty range: {uncertainty_range[0]:.3f} to {uncertainty_range[1]:.3f}')
 
-for df, shapes, path in zip(df_list, shapes_list, shape_paths):
-    can_names = df.columns[1:].to_list()
+def uncertainty_position(uncertainty):
+    # position of uncertainty in the uncertainty range, from 0 to 1
+    low, high = uncertainty_range
+    return min(1, max(0, (uncertainty - low) / (high - low))) if high > low else float(uncertainty > low)
+
+def uncertain_color(color, uncertainty):
+    # color with its saturation reduced by uncertainty, keeping V in HSV color space
+    s = 1 - uncertainty_position(uncertainty)
+    return color.max() + (color - color.max()) * s
+
+def uncertain_hatch(uncertainty):
+    position = uncertainty_position(uncertainty)
+    for minimum, hatch in HATCH_LEVELS:
+        if position >= minimum:
+            return hatch
+    return None
+
+# collect what to draw
+layers = []
+for df, shapes, topology, path in zip(df_list, shapes_list, topology_list, shape_paths):
+    can_names = df.columns[1:4].to_list()
     div_names = df.iloc[:, 0].to_list()
-    div_colors = df.iloc[:, 1:].to_numpy()
+    div_colors = df.iloc[:, 1:4].to_numpy()
+    div_hatches = [None] * len(div_names)
+    if uncertainty_mode == 'saturation':
+        div_colors = [uncertain_color(c, u) for c, u in zip(div_colors, df['不確定性'])]
+    elif uncertainty_mode == 'hatch':
+        div_hatches = [uncertain_hatch(u) for u in df['不確定性']]
     towns, villages, neighborhoods = shapes
 
     # neighborhoods
     village_set = set()
-    for pp_name, color in zip(div_names, div_colors):
-        v_name_list, n_name_list = parse_neighborhood_name(pp_name)
+    n_colors = {}
+    n_hatches = {}
+    for pp_name, color, hatch in zip(div_names, div_colors, div_hatches):
+        v_name_list, n_name_list = parse_neighborhood_name(pp_name, neighborhoods)
         for v_name in v_name_list:
             village_set.add(v_name)
         for n_name in n_name_list:
             if n_name not in neighborhoods:
                 print(f'warning: {n_name} not found in {path}')
                 continue
-            parts, centroid = neighborhoods[n_name]
-            points = []
-            codes = []
-            for part in parts:
-                assert len(part) >= 1, part
-                points += part
-                codes.append(Path.MOVETO)
-                codes.extend([Path.LINETO] * (len(part) - 1))
-            ax.add_patch(PathPatch(Path(points, codes), linewidth=0, facecolor=color))
-
-    # villages
-    for v_name, (parts, centroid) in villages.items():
-        if v_name not in village_set:
-            continue
-        for part in parts:
-            ax.plot(*zip(*part), color='w', linewidth=1)
-        ax.annotate(v_name, centroid, ha='center', va='center', fontsize=10)
-
-    # towns
-    for t_name, (parts, centroid) in towns.items():
-        for part in parts:
-            ax.plot(*zip(*part), color='w', linewidth=2)
-
-# title
-ax_title = fig.add_axes(plt.Axes(fig, (0, 0, 1, 1)))
-ax_title.set_axis_off()
-ax_title.set_xlim(0, 1)
-ax_title.set_ylim(0, 1)
-ax_title.annotate('、'.join(town_names) + '\n2024區域立委', (0.98, 0.98), ha='right', va='top', fontsize=40)
-
-# color reference
-ax_cref = fig.add_axes(plt.Axes(fig, (0.7, 0.4, 0.2, 0.19)))
-ax_cref.set_axis_off()
-ax_cref.imshow(plt.imread('asset/cref.png'))
-ax_cref.annotate(can_names[0], (256, 140), color='k', ha='center', va='center', fontsize=15)
-ax_cref.annotate(can_names[1], (110, 415), color='k', ha='center', va='center', fontsize=15)
-ax_cref.annotate(can_names[2], (400, 415), color='k', ha='center', va='center', fontsize=15)
-
-# color bar
-if 'ignorePR' not in RGB_names[0]:
-    ax_cbar = fig.add_axes(plt.Axes(fig, (0.7, 0.38, 0.2, 0.02)))
-    fig.colorbar(ScalarMappable(cmap='gray'), cax=ax_cbar, orientation='horizontal')
-    ax_cbar.set_xticks([0, 0.5, 1])
-    ax_cbar.set_xticklabels(['0%', '投票率', '100%'], fontsize=15)
-
-plt.savefig(f'{out_path_prefix}.png')
+            n_colors[n_name] = color
+            n_hatches[n_name] = hatch
+
+    # villages and towns
+    v_names = [v_name for v_name in villages if v_name in village_set]
+    layers.append({
+        'path': path,
+        'shapes': shapes,
+        'neighborhoods': neighborhoods,
+        'n_colors': n_colors,
+        'n_hatches': n_hatches,
+        'v_lines': boundary_lines(villages, v_names, topology and topology['villages']),
+        'v_labels': [(v_name, villages[v_name][1]) for v_name in v_names],
+        't_lines': boundary_lines(towns, list(towns), topology and topology['towns']),
+    })
+
+def neighborhood_patch(parts, color, hatch=None):
+    points = []
+    codes = []
+    for part in parts:
+        assert len(part) >= 1, part
+        points += part
+        codes.append(Path.MOVETO)
+        codes.extend([Path.LINETO] * (len(part) - 1))
+    if hatch is None:
+        return PathPatch(Path(points, codes), linewidth=0, facecolor=color)
+    return PathPatch(Path(points, codes), linewidth=0, facecolor=color, edgecolor='w', hatch=hatch)
+
+def draw_map(ax, cull=None):
+    # Draw all layers on ax. cull(layer, key, items) returns the items
+    # intersecting the current tile, see the poster section.
+    for layer in layers:
+        n_names = layer['n_colors'] if cull is None else cull(layer, 'neighborhoods', layer['n_colors'])
+        for n_name in n_names:
+            ax.add_patch(neighborhood_patch(layer['neighborhoods'][n_name][0], layer['n_colors'][n_name], layer['n_hatches'][n_name]))
+        lines = layer['v_lines'] if cull is None else cull(layer, 'v_lines', layer['v_lines'])
+        ax.add_collection(LineCollection(lines, colors='w', linewidths=1))
+        labels = layer['v_labels'] if cull is None else cull(layer, 'v_labels', layer['v_labels'])
+        for v_name, centroid in labels:
+            ax.annotate(v_name, centroid, ha='center', va='center', fontsize=10, annotation_clip=False)
+        lines = layer['t_lines'] if cull is None else cull(layer, 't_lines', layer['t_lines'])
+        ax.add_collection(LineCollection(lines, colors='w', linewidths=2))
+
+def draw_overlays(fig, place=None):
+    # Draw the title, color reference and color bar. place(rect) maps a rect
+    # in the figure coordinates of the whole image to the current figure, and
+    # returns None if the rect is not visible.
+    if place is None:
+        place = lambda rect: rect
+
+    # title
+    rect = place((0, 0, 1, 1))
+    if rect is not None:
+        ax_title = fig.add_axes(plt.Axes(fig, rect))
+        ax_title.set_axis_off()
+        ax_title.set_xlim(0, 1)
+        ax_title.set_ylim(0, 1)
+        ax_title.annotate('、'.join(town_names) + '\n2024區域立委', (0.98, 0.98), ha='right', va='top', fontsize=40)
+
+    # color reference
+    rect = place((0.7, 0.4, 0.2, 0.19))
+    if rect is not None:
+        ax_cref = fig.add_axes(plt.Axes(fig, rect))
+        ax_cref.set_axis_off()
+        ax_cref.imshow(plt.imread('asset/cref.png'))
+        ax_cref.annotate(can_names[0], (256, 140), color='k', ha='center', va='center', fontsize=15)
+        ax_cref.annotate(can_names[1], (110, 415), color='k', ha='center', va='center', fontsize=15)
+        ax_cref.annotate(can_names[2], (400, 415), color='k', ha='center', va='center', fontsize=15)
+
+    # color bar
+    rect = place((0.7, 0.38, 0.2, 0.02))
+    if 'ignorePR' not in RGB_names[0] and rect is not None:
+        ax_cbar = fig.add_axes(plt.Axes(fig, rect))
+        fig.colorbar(ScalarMappable(cmap='gray'), cax=ax_cbar, orientation='horizontal')
+        ax_cbar.set_xticks([0, 0.5, 1])
+        ax_cbar.set_xticklabels(['0%', '投票率', '100%'], fontsize=15)
+
+# create figure
+fig = plt.figure(figsize=(10, 10), dpi=100)
+ax = create_map_axes(fig)
+ax.set_aspect(aspect, 'datalim')
+ax.margins(x=0.01, y=0.01)
+draw_map(ax)
+
+if poster_size is None:
+    draw_overlays(fig)
+    plt.savefig(f'{out_path_prefix}.png')
+    exit()
+
+# %% export to poster
+
+import zlib, struct
+
+class PNGWriter:
+    # Write an RGB PNG file strip by strip, without holding the whole image.
+    def __init__(self, path, width, height):
+        self.f = open(path, 'wb')
+        self.width = width
+        self.compressor = zlib.compressobj(6)
+        self.f.write(b'\x89PNG\r\n\x1a\n')
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+    def write_chunk(self, chunk_type, data):
+        self.f.write(struct.pack('>I', len(data)) + chunk_type + data)
+        self.f.write(struct.pack('>I', zlib.crc32(chunk_type + data) & 0xFFFFFFFF))
+    def write_rows(self, rows):
+        # rows: uint8 array of shape (height, width, 3)
+        assert rows.shape[1:] == (self.width, 3), rows.shape
+        filtered = np.zeros((rows.shape[0], self.width * 3 + 1), dtype=np.uint8) # filter type 0
+        filtered[:, 1:] = rows.reshape(rows.shape[0], -1)
+        data = self.compressor.compress(filtered.tobytes())
+        if data:
+            self.write_chunk(b'IDAT', data)
+    def close(self):
+        self.write_chunk(b'IDAT', self.compressor.flush())
+        self.write_chunk(b'IEND', b'')
+        self.f.close()
+
+# the data limits of the poster are the same as those of the default image
+ax.apply_aspect()
+x_min, x_max = ax.get_xlim()
+y_min, y_max = ax.get_ylim()
+plt.close(fig)
+
+# bboxes of the items to cull
+sys.path.append('../collect_shapes')
+from shape_index import ShapeIndex
+def line_bboxes(lines):
+    bboxes = np.zeros((len(lines), 4))
+    for l, line in enumerate(lines):
+        xy = np.asarray(line)
+        bboxes[l] = *xy.min(axis=0), *xy.max(axis=0)
+    return bboxes
+for layer in layers:
+    if cartogram_weighting is None:
+        layer['index'] = ShapeIndex.load(layer['path']).neighborhoods
+    else: # warped shapes
+        layer['index'] = ShapeIndex(layer['shapes']).neighborhoods
+    layer['v_lines_bboxes'] = line_bboxes(layer['v_lines'])
+    layer['t_lines_bboxes'] = line_bboxes(layer['t_lines'])
+    layer['v_labels_bboxes'] = np.array([(*c, *c) for v_name, c in layer['v_labels']]).reshape(-1, 4)
+
+scale = poster_size / 1000 # relative to the default image
+dpi = 100 * scale
+x_per_px = (x_max - x_min) / poster_size
+y_per_px = (y_max - y_min) / poster_size
+geometry_margin = 4 * scale # in pixels, for line widths
+label_margin = 100 * scale # in pixels, for label sizes
+
+writer = PNGWriter(f'{out_path_prefix}.png', poster_size, poster_size)
+for y0 in range(0, poster_size, tile_size):
+    th = min(tile_size, poster_size - y0)
+    strip = np.zeros((th, poster_size, 3), dtype=np.uint8)
+    for x0 in range(0, poster_size, tile_size):
+        tw = min(tile_size, poster_size - x0)
+        fig = plt.figure(figsize=(tw / dpi, th / dpi), dpi=dpi)
+        ax = create_map_axes(fig)
+        ax.set_xlim(x_min + x0 * x_per_px, x_min + (x0 + tw) * x_per_px)
+        ax.set_ylim(y_max - (y0 + th) * y_per_px, y_max - y0 * y_per_px)
+
+        def tile_bbox(margin):
+            return (x_min + (x0 - margin) * x_per_px, y_max - (y0 + th + margin) * y_per_px,
+                x_min + (x0 + tw + margin) * x_per_px, y_max - (y0 - margin) * y_per_px)
+        def cull(layer, key, items):
+            if key == 'neighborhoods':
+                return [n for n in layer['index'].query_bbox(tile_bbox(geometry_margin)) if n in items]
+            bx0, by0, bx1, by1 = tile_bbox(label_margin if key == 'v_labels' else geometry_margin)
+            b = layer[f'{key}_bboxes']
+            hit = (b[:, 0] <= bx1) & (b[:, 2] >= bx0) & (b[:, 1] <= by1) & (b[:, 3] >= by0)
+            return [items[i] for i in np.flatnonzero(hit)]
+        def place(rect):
+            l, b, w, h = rect
+            left, bottom = l * poster_size - x0, b * poster_size - (poster_size - y0 - th)
+            width, height = w * poster_size, h * poster_size
+            if left > tw + label_margin or left + width < -label_margin or \
+                    bottom > th + label_margin or bottom + height < -label_margin:
+                return None
+            return (left / tw, bottom / th, width / tw, height / th)
+
+        draw_map(ax, cull)
+        draw_overlays(fig, place)
+        fig.canvas.draw()
+        tile = np.asarray(fig.canvas.buffer_rgba())[:th, :tw, :3]
+        strip[:tile.shape[0], x0:x0+tile.shape[1]] = tile
+        plt.close(fig)
+    writer.write_rows(strip)
+    print(f'rendered rows {y0 + th} / {poster_size}')
+writer.close()
+print(f'generated file: {out_path_prefix}.png')
 
 # %%
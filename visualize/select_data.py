@@ -17,6 +17,15 @@
 # --ignorePR        Set participation rate to 1.0.
 #                   This makes the colors as bright as possible,
 #                   but eliminates information of participation rate.
+# --uncertainty[=<resamples>]
+#                   Add 95% confidence intervals of the R, G, B vote shares
+#                   and the participation rate of each division, from
+#                   <resamples> (1000 by default) multinomial resamples of
+#                   the (R, G, B, other, non-voter) counts of its eligible voters.
+#                   The widest interval is added as the `不確定性` column,
+#                   which `export.py --uncertainty=...` renders as reduced
+#                   saturation or hatching, so that small divisions are not
+#                   shown with the same confidence as large ones.
 
 # To customize further, Google Sheets or similar software is recommended.
 # Please refer to the example `rgb/南港.csv` file for the required format.
@@ -61,6 +70,7 @@ R_label = 'default'
 G_label = 'default'
 B_label = 'default'
 ignorePR = False
+resamples = 0
 for option in argv[2:]:
     if option.startswith('--out='):
         out_file_path = f'rgb/{option[6:]}.csv'
@@ -72,6 +82,10 @@ for option in argv[2:]:
         B_label = option[7:]
     elif option == '--ignorePR':
         ignorePR = True
+    elif option == '--uncertainty':
+        resamples = 1000
+    elif option.startswith('--uncertainty='):
+        resamples = int(option[14:])
     else:
         print(f'unknown option: {option}')
         exit()
@@ -129,8 +143,8 @@ assert len(set((R_label, G_label, B_label))) == 3, 'R, G, B labels have to be di
 import numpy as np
 
 # normalize
-RGB_data = np.stack([R_data, G_data, B_data], axis=1)
-RGB_data = RGB_data / RGB_data.max(axis=1, keepdims=True)
+RGB_counts = np.stack([R_data, G_data, B_data], axis=1)
+RGB_data = RGB_counts / RGB_counts.max(axis=1, keepdims=True)
 np.nan_to_num(RGB_data, copy=False, nan=0.0, posinf=0.0)
 
 # rescale to participation rate
@@ -144,12 +158,61 @@ else:
 
 R_data, G_data, B_data = RGB_data.T
 
+# %% confidence intervals
+
+CHUNK_SIZE = 1 << 22 # elements in a batch of resamples
+CONFIDENCE = 0.95
+
+if resamples > 0:
+    # counts of (R, G, B, other votes, non-voters) of each division
+    votes = table[:, :-1].sum(axis=1)
+    counts = np.concatenate([
+        RGB_counts,
+        np.maximum(votes - RGB_counts.sum(axis=1), 0)[:, None],
+        np.maximum(table[:, -1] - votes, 0)[:, None],
+    ], axis=1).astype(np.int64)
+    N = counts.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pvals = np.nan_to_num(counts / N[:, None])
+
+    # resample all divisions in batches of shape (divisions, resamples, categories)
+    rng = np.random.default_rng(0)
+    quantiles = [(1 - CONFIDENCE) / 2, (1 + CONFIDENCE) / 2]
+    share_CI = np.zeros((2, len(counts), 3)) # (low/high, division, R/G/B)
+    PR_CI = np.zeros((2, len(counts)))
+    batch = max(1, CHUNK_SIZE // (resamples * counts.shape[1]))
+    for start in range(0, len(counts), batch):
+        stop = min(start + batch, len(counts))
+        samples = rng.multinomial(N[start:stop, None], pvals[start:stop, None, :],
+            size=(stop - start, resamples)).astype(np.float64)
+        sample_votes = samples[:, :, :4].sum(axis=2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shares = samples[:, :, :3] / sample_votes[:, :, None]
+            PRs = sample_votes / N[start:stop, None]
+        share_CI[:, start:stop] = np.quantile(np.nan_to_num(shares), quantiles, axis=1)
+        PR_CI[:, start:stop] = np.quantile(np.nan_to_num(PRs), quantiles, axis=1)
+
+    # divisions without votes are completely uncertain
+    share_CI[0, votes == 0], share_CI[1, votes == 0] = 0.0, 1.0
+    PR_CI[0, N == 0], PR_CI[1, N == 0] = 0.0, 1.0
+    widths = share_CI[1] - share_CI[0]
+    if not ignorePR:
+        widths = np.concatenate([widths, (PR_CI[1] - PR_CI[0])[:, None]], axis=1)
+    uncertainty = widths.max(axis=1)
+    print(f'confidence intervals from {resamples} resamples, median uncertainty: {np.median(uncertainty):.3f}')
+
 # %% output
 
 metadata = f'{county} {town} {div_type}'
-df_out = pandas.DataFrame(
-    data={metadata: df.columns[3:], R_label: R_data, G_label: G_data, B_label: B_data},
-    columns=[metadata, R_label, G_label, B_label])
+data = {metadata: df.columns[3:], R_label: R_data, G_label: G_data, B_label: B_data}
+if resamples > 0:
+    for c, label in enumerate([R_label, G_label, B_label]):
+        data[f'{label} 得票率下限'] = share_CI[0, :, c]
+        data[f'{label} 得票率上限'] = share_CI[1, :, c]
+    data['投票率下限'] = PR_CI[0]
+    data['投票率上限'] = PR_CI[1]
+    data['不確定性'] = uncertainty
+df_out = pandas.DataFrame(data=data, columns=list(data))
 df_out.to_csv(out_file_path, index=False)
 print(f'generated file: {out_file_path}')
 
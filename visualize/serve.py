@@ -0,0 +1,368 @@
+# Serve vote tables, RGB files and simplified shapes over HTTP (read-only).
+
+# A local data API for interactive webpages, so that a client fetches only the
+# divisions it shows instead of every file of every town. All files are loaded
+# once at startup, and the server is a single asyncio process using only the
+# standard library for HTTP.
+
+# Endpoints (all responses are JSON):
+#   GET /
+#       Names of the available data, RGB and shape files.
+#   GET /data/<data name>[?division=<id>,<id>,...]
+#       Vote table of `data/<data name>.csv`, e.g., /data/臺北市_南港區_立委第4選區_投開票所
+#       {"numbers": [...], "candidates": [...], "parties": [...],
+#        "divisions": [...], "votes": [[<votes of each candidate>], ...], "eligible": [...]}
+#   GET /rgb/<RGB name>[?division=<id>,<id>,...]
+#       Colors of `visualize/rgb/<RGB name>.csv`, e.g., /rgb/南港
+#       {"title": ..., "labels": [R, G, B], "divisions": [...], "rgb": [[r, g, b], ...]}
+#       and "uncertainty": [...] if the file has uncertainty (see `select_data.py --uncertainty`)
+#   GET /shapes/<shape name>/<level>[?bbox=<x0>,<y0>,<x1>,<y1>][&id=<name>,<name>,...]
+#       GeoJSON features of a level (towns, villages or neighborhoods) of
+#       `shapes/<shape name>.pkl` intersecting the bbox (found with the spatial
+#       index of `collect_shapes/shape_index.py`) and/or with the given names,
+#       e.g., /shapes/臺北市_南港區/villages?bbox=121.60,25.04,121.62,25.06
+#       Geometries are MultiPolygons with holes, wound as in RFC 7946.
+# Division ids are the column names of the data files, i.e., the first column
+# of the RGB files, e.g., 南港里 or 南港里_2_3_4_5_6_7. Names in the path and
+# the query are percent-encoded as usual.
+
+# Shapes are simplified along the shared arcs of their topology (see
+# `collect_shapes/topology.py`), so that adjacent features stay free of gaps.
+# Responses are gzip-compressed if the client accepts it, and have ETags
+# derived from the SHA-256 of the files they come from and the query, so that
+# clients revalidate with If-None-Match and get 304 without a body. Built
+# responses are kept in an LRU cache.
+
+# Requirements:
+#   <python> -m pip install pandas numpy
+# Usage:
+#   <python> serve.py [<option> ...]
+# Options:
+# --port=<port>             Port to listen on, 8000 by default.
+# --host=<host>             Host to listen on, 127.0.0.1 by default.
+# --tolerance=<degrees>     Tolerance of shape simplification, 1e-5 (about 1 m) by default.
+# Example usage:
+#   <python> serve.py --port=8000
+#   curl --compressed 'http://127.0.0.1:8000/rgb/%E5%8D%97%E6%B8%AF'
+
+# %% parse options
+
+import sys, glob, json, gzip, hashlib, pickle, asyncio, pandas
+import numpy as np
+from collections import OrderedDict
+from urllib.parse import unquote, parse_qs
+sys.path.append('../collect_shapes')
+from shape_index import ShapeIndex, LEVELS
+from topology import topology_path, level_parts, simplify_level
+
+argv = sys.argv
+host = '127.0.0.1'
+port = 8000
+tolerance = 1e-5
+for option in argv[1:]:
+    if option.startswith('--port='):
+        port = int(option[7:])
+    elif option.startswith('--host='):
+        host = option[7:]
+    elif option.startswith('--tolerance='):
+        tolerance = float(option[12:])
+    else:
+        print(f'unknown option: {option}')
+        exit()
+
+CACHE_SIZE = 1024 # built responses
+GZIP_MIN_SIZE = 256 # bytes
+REQUEST_LIMIT = 1 << 16 # bytes of request line and headers
+
+# %% load data
+
+def file_digest(*paths):
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def file_name(path):
+    return path.replace('\\', '/').split('/')[-1][:-len('.csv')]
+
+data_tables = {}
+for path in sorted(glob.glob('../data/*.csv')):
+    df = pandas.read_csv(path)
+    table = df.iloc[:, 3:].to_numpy().T
+    data_tables[file_name(path)] = {
+        'digest': file_digest(path),
+        'numbers': df['號次'].to_list()[:-1],
+        'candidates': df['名字'].to_list()[:-1],
+        'parties': df['政黨'].to_list()[:-1],
+        'divisions': df.columns[3:].to_list(),
+        'votes': table[:, :-1].tolist(),
+        'eligible': table[:, -1].tolist(),
+    }
+print(f'read {len(data_tables)} data files')
+
+rgb_tables = {}
+for path in sorted(glob.glob('rgb/*.csv')):
+    df = pandas.read_csv(path)
+    rgb_tables[file_name(path)] = {
+        'digest': file_digest(path),
+        'title': df.columns[0],
+        'labels': df.columns[1:4].to_list(),
+        'divisions': df.iloc[:, 0].to_list(),
+        'rgb': df.iloc[:, 1:4].to_numpy().tolist(),
+    }
+    if '不確定性' in df.columns:
+        rgb_tables[file_name(path)]['uncertainty'] = df['不確定性'].to_list()
+print(f'read {len(rgb_tables)} RGB files')
+
+def signed_area(ring):
+    x, y = np.asarray(ring, dtype=np.float64).T
+    return float((x * np.roll(y, -1) - np.roll(x, -1) * y).sum() / 2)
+
+def ring_contains(ring, x, y):
+    # even-odd test of the point (x, y), as in `collect_shapes/shape_index.py`
+    x0, y0 = np.asarray(ring, dtype=np.float64).T
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    crosses = (y0 > y) != (y1 > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crosses &= x < x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+    return int(crosses.sum()) % 2 == 1
+
+def polygon_coordinates(rings, parts):
+    # GeoJSON MultiPolygon coordinates of the simplified rings of a feature,
+    # whose original rings are parts. A ring inside an odd number of the other
+    # rings is a hole of the smallest ring containing it. Outer rings are
+    # counter-clockwise and holes clockwise (RFC 7946), while shapefiles have
+    # clockwise outer rings.
+    if len(parts) == 1:
+        return [[rings[0] if signed_area(rings[0]) > 0 else rings[0][::-1]]]
+    areas = [abs(signed_area(part)) for part in parts]
+    parents = []
+    for i, part in enumerate(parts):
+        containers = []
+        for j, other in enumerate(parts):
+            if j == i or areas[j] <= areas[i]:
+                continue
+            # a vertex of part not on other, as neighboring rings share arcs
+            vertices = set(other)
+            point = next((v for v in part if v not in vertices), None)
+            if point is not None and ring_contains(other, *point):
+                containers.append(j)
+        parents.append(min(containers, key=lambda j: areas[j]) if len(containers) % 2 == 1 else None)
+    polygons = {}
+    for i, ring in enumerate(rings):
+        if parents[i] is None:
+            polygons[i] = [ring if signed_area(ring) > 0 else ring[::-1]]
+    for i, ring in enumerate(rings):
+        if parents[i] is not None:
+            polygons[parents[i]].append(ring if signed_area(ring) < 0 else ring[::-1])
+    return list(polygons.values())
+
+shape_levels = {}
+for path in sorted(glob.glob('../shapes/*.pkl')):
+    if path.endswith('.index.pkl') or path.endswith('.topology.pkl'):
+        continue
+    name = path.replace('\\', '/').split('/')[-1][:-len('.pkl')]
+    with open(path, 'rb') as f:
+        shapes = pickle.load(f)
+    with open(topology_path(path), 'rb') as f:
+        topology = pickle.load(f)
+    index = ShapeIndex.load(path)
+    digest = file_digest(path, topology_path(path)) + f' {tolerance}'
+    for level, features in zip(LEVELS, shapes):
+        level_index = getattr(index, level)
+        parts = simplify_level(topology[level], tolerance)
+        original = level_parts(topology[level])
+        # GeoJSON of each feature, in the order of the index
+        fragments = []
+        for n_name in level_index.names:
+            fragments.append(json.dumps({
+                'type': 'Feature',
+                'properties': {'name': n_name, 'centroid': features[n_name][1]},
+                'geometry': {'type': 'MultiPolygon', 'coordinates': polygon_coordinates(parts[n_name], original[n_name])},
+            }, ensure_ascii=False, separators=(',', ':')))
+        shape_levels[(name, level)] = {
+            'digest': digest,
+            'index': level_index,
+            'ids': {n_name: i for i, n_name in enumerate(level_index.names)},
+            'fragments': fragments,
+        }
+    print(f'read shape file: {path}')
+
+# %% responses
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def parse_list(query, key):
+    if key not in query:
+        return None
+    return [v for value in query[key] for v in value.split(',') if v]
+
+def select_divisions(table, query, keys):
+    # the table restricted to the divisions in the query, if any
+    divisions = parse_list(query, 'division')
+    result = {key: value for key, value in table.items() if key != 'digest'}
+    if divisions is None:
+        return result
+    didx = {d: i for i, d in enumerate(table['divisions'])}
+    unknown = [d for d in divisions if d not in didx]
+    if unknown:
+        raise HTTPError(404, f'unknown divisions: {", ".join(unknown)}')
+    for key in keys:
+        result[key] = [table[key][didx[d]] for d in divisions]
+    return result
+
+def resolve(path, query):
+    # (digest of the source files, function building the JSON body) of a request
+    parts = [unquote(p) for p in path.strip('/').split('/')] if path.strip('/') else []
+    if len(parts) == 0:
+        index = {
+            'data': list(data_tables),
+            'rgb': list(rgb_tables),
+            'shapes': sorted({name for name, level in shape_levels}),
+            'levels': list(LEVELS),
+        }
+        digest = ' '.join(t['digest'] for t in [*data_tables.values(), *rgb_tables.values(), *shape_levels.values()])
+        return digest, lambda: index
+    if len(parts) == 2 and parts[0] == 'data' and parts[1] in data_tables:
+        table = data_tables[parts[1]]
+        return table['digest'], lambda: select_divisions(table, query, ('divisions', 'votes', 'eligible'))
+    if len(parts) == 2 and parts[0] == 'rgb' and parts[1] in rgb_tables:
+        table = rgb_tables[parts[1]]
+        return table['digest'], lambda: select_divisions(table, query, [k for k in ('divisions', 'rgb', 'uncertainty') if k in table])
+    if len(parts) == 3 and parts[0] == 'shapes' and (parts[1], parts[2]) in shape_levels:
+        level = shape_levels[(parts[1], parts[2])]
+        return level['digest'], lambda: select_features(level, query)
+    raise HTTPError(404, f'not found: {path}')
+
+def select_features(level, query):
+    ids = np.arange(len(level['fragments']))
+    bbox = parse_list(query, 'bbox')
+    if bbox is not None:
+        try:
+            x0, y0, x1, y1 = map(float, bbox)
+        except ValueError:
+            raise HTTPError(400, f'bad bbox: {",".join(bbox)}')
+        ids = level['index'].query_bbox_ids((x0, y0, x1, y1))
+    names = parse_list(query, 'id')
+    if names is not None:
+        unknown = [n for n in names if n not in level['ids']]
+        if unknown:
+            raise HTTPError(404, f'unknown ids: {", ".join(unknown)}')
+        ids = np.intersect1d(ids, [level['ids'][n] for n in names])
+    # the fragments are JSON already
+    features = ','.join(level['fragments'][i] for i in np.sort(ids))
+    return RawJSON('{"type":"FeatureCollection","features":[' + features + ']}')
+
+class RawJSON(str):
+    pass
+
+cache = OrderedDict()
+
+def respond(path, query_string, accept_gzip, if_none_match):
+    # (status, headers, body) of a GET request
+    query = parse_qs(query_string, keep_blank_values=False)
+    canonical = json.dumps(sorted((k, sorted(v)) for k, v in query.items()), ensure_ascii=False)
+    digest, build = resolve(path, query)
+    encoding = 'gzip' if accept_gzip else 'identity'
+    etag = '"' + hashlib.sha256(f'{digest} {unquote(path)} {canonical}'.encode()).hexdigest()[:32] + \
+        ('-gz"' if accept_gzip else '"')
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+    if if_none_match is not None and etag in [t.strip() for t in if_none_match.split(',')]:
+        return 304, headers, b''
+    key = (etag, encoding)
+    if key in cache:
+        cache.move_to_end(key)
+        body, encoding = cache[key]
+    else:
+        result = build()
+        body = (result if isinstance(result, RawJSON) else \
+            json.dumps(result, ensure_ascii=False, separators=(',', ':'))).encode()
+        if accept_gzip and len(body) >= GZIP_MIN_SIZE:
+            body = gzip.compress(body, compresslevel=6, mtime=0)
+        else:
+            encoding = 'identity'
+        cache[key] = body, encoding
+        if len(cache) > CACHE_SIZE:
+            cache.popitem(last=False)
+    headers['Content-Type'] = 'application/json; charset=utf-8'
+    if encoding == 'gzip':
+        headers['Content-Encoding'] = 'gzip'
+    return 200, headers, body
+
+# %% HTTP server
+
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+    405: 'Method Not Allowed', 431: 'Request Header Fields Too Large', 500: 'Internal Server Error'}
+
+def error_response(status, message):
+    body = json.dumps({'error': message}, ensure_ascii=False).encode()
+    return status, {'Content-Type': 'application/json; charset=utf-8'}, body
+
+async def handle_connection(reader, writer):
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+            except asyncio.LimitOverrunError:
+                status, headers, body = error_response(431, 'request header fields too large')
+                keep_alive = False
+                method = 'GET'
+            else:
+                lines = head.decode('latin-1').split('\r\n')
+                request_line = lines[0].split(' ')
+                fields = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        k, v = line.split(':', 1)
+                        fields[k.strip().lower()] = v.strip()
+                if len(request_line) != 3:
+                    method, version = 'GET', 'HTTP/1.0'
+                    status, headers, body = error_response(400, 'bad request line')
+                else:
+                    method, target, version = request_line
+                    if method not in ('GET', 'HEAD'):
+                        status, headers, body = error_response(405, f'method not allowed: {method}')
+                    else:
+                        path, _, query_string = target.partition('?')
+                        accept_gzip = 'gzip' in fields.get('accept-encoding', '')
+                        try:
+                            status, headers, body = respond(path, query_string, accept_gzip, fields.get('if-none-match'))
+                        except HTTPError as e:
+                            status, headers, body = error_response(e.status, str(e))
+                        except Exception as e:
+                            print(f'error: {method} {target}: {e!r}')
+                            status, headers, body = error_response(500, 'internal server error')
+                connection = fields.get('connection', '').lower()
+                keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+                keep_alive &= 'content-length' not in fields and 'transfer-encoding' not in fields
+            if status != 304: # no Content-Length for 304, which never has a body
+                headers['Content-Length'] = str(len(body))
+            headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+            response = f'HTTP/1.1 {status} {REASONS[status]}\r\n' + \
+                ''.join(f'{k}: {v}\r\n' for k, v in headers.items()) + '\r\n'
+            writer.write(response.encode('latin-1') + (b'' if method == 'HEAD' else body))
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def main():
+    server = await asyncio.start_server(handle_connection, host, port, limit=REQUEST_LIMIT, backlog=1024)
+    print(f'serving on http://{host}:{port}/')
+    async with server:
+        await server.serve_forever()
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+# %%
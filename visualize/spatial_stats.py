@@ -0,0 +1,128 @@
+# Spatial autocorrelation (Moran's I) of vote shares in a CSV file.
+
+# The adjacency graph of divisions comes from the topology saved next to the
+# shape pickle (see `collect_shapes/topology.py`). Two villages are adjacent if
+# they share a boundary arc, and two polling places are adjacent if any of
+# their neighborhoods are. Weights are row-standardized.
+
+# For each candidate, this prints the global Moran's I of the vote share
+# (votes / sum of votes) with a pseudo p-value from random permutations, all
+# computed as a single batched array operation. The local Moran's I and the
+# cluster type (HH, LL, HL, LH) of each division are written to `stats/`.
+
+# Requirements:
+#   <python> -m pip install pandas numpy
+# Usage:
+#   <python> spatial_stats.py ../data/<data name>.csv [--permutations=<number>]
+# Example usage:
+#   <python> spatial_stats.py ../data/臺北市_南港區_立委第4選區_投開票所.csv
+# Example output:
+#   stats/臺北市_南港區_立委第4選區_投開票所_moran.csv
+
+# %% parse options
+
+import sys, os, pickle, pandas
+import numpy as np
+sys.path.append('../distill_data')
+from aggregate import parse_neighborhood_name
+
+argv = sys.argv
+assert len(argv) >= 2, argv
+in_file_path = argv[1]
+permutations = 999
+for option in argv[2:]:
+    if option.startswith('--permutations='):
+        permutations = int(option[15:])
+    else:
+        print(f'unknown option: {option}')
+        exit()
+
+df = pandas.read_csv(in_file_path)
+print(f'read CSV file: {in_file_path}')
+in_file_name = in_file_path.replace('\\', '/').split('/')[-1]
+county, town = in_file_name.split('_')[:2]
+div_type = '投開票所' if '投開票所' in in_file_name else '村里'
+path = f'../shapes/{county}_{town}.topology.pkl'
+with open(path, 'rb') as f:
+    topology = pickle.load(f)
+print(f'read topology file: {path}')
+
+# %% adjacency graph of divisions
+
+def group_adjacency(indptr, indices, groups, n_groups):
+    # CSR adjacency of groups, where groups[i] is the group of node i (-1 for none)
+    indptr, indices = np.asarray(indptr), np.asarray(indices, dtype=np.intp)
+    src = groups[np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))]
+    dst = groups[indices]
+    keep = (src >= 0) & (dst >= 0) & (src != dst)
+    edges = np.unique(np.stack([src[keep], dst[keep]], axis=1), axis=0).reshape(-1, 2)
+    return np.searchsorted(edges[:, 0], np.arange(n_groups + 1)), edges[:, 1]
+
+div_names = df.columns[3:].to_list()
+if div_type == '村里':
+    level = topology['villages']
+    didx = {name: d for d, name in enumerate(div_names)}
+    groups = np.array([didx.get(name, -1) for name in level['names']], dtype=np.intp)
+else:
+    level = topology['neighborhoods']
+    groups = np.full(len(level['names']), -1, dtype=np.intp)
+    nidx = {name: n for n, name in enumerate(level['names'])}
+    for d, pp_name in enumerate(div_names):
+        for n_name in parse_neighborhood_name(pp_name, level['names'])[1]:
+            if n_name not in nidx:
+                print(f'warning: {n_name} not found in {path}')
+                continue
+            groups[nidx[n_name]] = d
+indptr, indices = group_adjacency(level['indptr'], level['indices'], groups, len(div_names))
+degree = np.diff(indptr)
+print(f'{len(div_names)} divisions, {len(indices) // 2} adjacent pairs, {(degree == 0).sum()} without neighbors')
+
+# %% Moran's I
+
+def spatial_lag(z):
+    # row-standardized spatial lag of z, of shape (divisions, ...)
+    c = np.concatenate([np.zeros((1, *z.shape[1:])), np.cumsum(z[indices], axis=0)])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lag = (c[indptr[1:]] - c[indptr[:-1]]) / degree.reshape(-1, *[1] * (z.ndim - 1))
+    return np.nan_to_num(lag)
+
+def morans_i(z):
+    # global Moran's I of each column of z, which is centered along axis 0
+    return (len(z) / (degree > 0).sum()) * (z * spatial_lag(z)).sum(axis=0) / (z * z).sum(axis=0)
+
+table = df.iloc[:, 3:].to_numpy().T.astype(np.float64)
+votes = table[:, :-1]
+with np.errstate(divide='ignore', invalid='ignore'):
+    shares = np.nan_to_num(votes / votes.sum(axis=1, keepdims=True))
+z = shares - shares.mean(axis=0)
+I = morans_i(z)
+
+# pseudo p-values: permutations of each candidate, as a (divisions, candidates, permutations) array
+rng = np.random.default_rng(0)
+order = rng.random((len(z), permutations)).argsort(axis=0)
+I_perm = morans_i(z[order].transpose(0, 2, 1))
+p = ((I_perm >= I[:, None]).sum(axis=1) + 1) / (permutations + 1)
+p = np.minimum(p, ((I_perm <= I[:, None]).sum(axis=1) + 1) / (permutations + 1))
+print('candidate: Moran\'s I (pseudo p-value)')
+for name, i, pi in zip(df['名字'].to_list()[:-1], I, p):
+    print(f'  {name}: {i:.3f} ({pi:.3f})')
+
+# local Moran's I and cluster types
+lag = spatial_lag(z)
+local_I = z * lag / (z * z).mean(axis=0)
+cluster = np.where(z > 0, np.where(lag > 0, 'HH', 'HL'), np.where(lag > 0, 'LH', 'LL'))
+cluster[degree == 0] = '-'
+
+# %% output
+
+data = {div_type: div_names}
+for c, name in enumerate(df['名字'].to_list()[:-1]):
+    data[f'{name} 得票率'] = shares[:, c]
+    data[f'{name} local I'] = local_I[:, c]
+    data[f'{name} cluster'] = cluster[:, c]
+os.makedirs('stats', exist_ok=True)
+out_file_path = f'stats/{in_file_name[:-len(".csv")]}_moran.csv'
+pandas.DataFrame(data).to_csv(out_file_path, index=False)
+print(f'generated file: {out_file_path}')
+
+# %%